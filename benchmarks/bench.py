@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+#
+# End to end throughput benchmark of GYB against the fake Gmail server in
+# fakegmail.py. Each scenario runs gyb.py as its own process and reports
+# messages and megabytes per second:
+#
+#   backup       full backup of the generated mailbox into an empty folder
+#   incremental  backup after --new-messages messages arrived
+#   refresh      backup after the labels and flags of a fifth of the messages changed
+#   estimate     estimate of the whole mailbox without a backup folder
+#   reindex      --action reindex of the backup
+#   restore      restore of the backup into an empty mailbox
+#
+#   python benchmarks/bench.py --messages 5000 --save baseline.json
+#   python benchmarks/bench.py --messages 5000 --compare baseline.json
+#
+# With --compare the exit status is 1 if a scenario got slower than the
+# baseline by more than --tolerance.
+
+import json
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakegmail
+
+GYB = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'gyb.py')
+SCENARIOS = ('backup', 'incremental', 'refresh', 'estimate', 'reindex', 'restore')
+
+def run_gyb(server, work_folder, options, args):
+  '''
+  Args:
+    server: object, the fakegmail.Server to connect to
+    work_folder: string, the folder with the key file
+    options: object, the benchmark options
+    args: list, the gyb.py arguments of the scenario
+
+  Returns:
+    float, the seconds gyb.py took
+  '''
+  key_file = os.path.join(work_folder, 'key.txt')
+  command = [sys.executable, GYB, '-e', 'user@example.com', '-t', key_file,
+             '--imap-host', '127.0.0.1', '--imap-port', str(server.server_address[1])]
+  if not server.certfile:
+    command.append('--imap-plaintext')
+  if options.stats_file:
+    command += ['--stats-file', options.stats_file]
+  command += args + options.gyb_args
+  started = time.time()
+  with open(os.path.join(work_folder, 'gyb.log'), 'a') as log:
+    log.write('\n$ %s\n' % ' '.join(command))
+    log.flush()
+    status = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+  seconds = time.time() - started
+  if status != 0:
+    print 'Error: %s exited with %s, see %s' % (' '.join(args), status,
+                                                 os.path.join(work_folder, 'gyb.log'))
+    sys.exit(status)
+  return seconds
+
+def mailbox_bytes(messages):
+  return sum(len(message.body) for message in messages)
+
+def run_scenarios(options, work_folder):
+  '''
+  Returns:
+    dict, scenario name to a dict of seconds, messages, msgs_per_s and mb_per_s
+  '''
+  print 'Generating %s messages...' % options.messages
+  mailbox = fakegmail.generate_mailbox(options.messages, options.seed,
+                                       attachment_rate=options.attachment_rate)
+  server = fakegmail.serve_in_thread(mailbox, options.certfile, options.latency, options.bandwidth)
+  backup_folder = os.path.join(work_folder, 'backup')
+  folder_args = ['-f', backup_folder]
+  with open(os.path.join(work_folder, 'key.txt'), 'w') as f:
+    f.write('key\nsecret')
+  rng = random.Random(options.seed)
+  results = {}
+  def record(scenario, seconds, messages, total_bytes=None):
+    result = {'seconds': round(seconds, 3),
+              'messages': messages,
+              'msgs_per_s': round(messages / seconds, 1)}
+    if total_bytes is not None:
+      result['mb_per_s'] = round(total_bytes / 1048576.0 / seconds, 3)
+    results[scenario] = result
+    print '%-12s %8.2fs %8s msgs %10.1f msgs/s %10s MB/s' % (
+        scenario, seconds, messages, result['msgs_per_s'], result.get('mb_per_s', '-'))
+
+  if 'backup' in options.scenarios:
+    seconds = run_gyb(server, work_folder, options, folder_args + ['--action', 'backup'])
+    record('backup', seconds, len(mailbox.messages), mailbox_bytes(mailbox.messages))
+  if 'incremental' in options.scenarios:
+    new_mailbox = fakegmail.generate_mailbox(options.new_messages, options.seed + 1,
+                                             attachment_rate=options.attachment_rate)
+    for message in new_mailbox.messages:
+      mailbox.add(message.body, message.labels, message.flags, message.date)
+    seconds = run_gyb(server, work_folder, options, folder_args + ['--action', 'backup'])
+    record('incremental', seconds, len(new_mailbox.messages), mailbox_bytes(new_mailbox.messages))
+  if 'refresh' in options.scenarios:
+    with mailbox.lock:
+      for message in rng.sample(mailbox.messages, len(mailbox.messages) // 5):
+        if message.labels and rng.random() < 0.5:
+          message.labels.pop()
+        else:
+          message.labels.append('Refreshed')
+          mailbox.labels.add('Refreshed')
+        if '\\Seen' in message.flags:
+          message.flags.remove('\\Seen')
+        else:
+          message.flags.append('\\Seen')
+        mailbox.touch(message)
+    seconds = run_gyb(server, work_folder, options, folder_args + ['--action', 'backup'])
+    record('refresh', seconds, len(mailbox.messages))
+  if 'estimate' in options.scenarios:
+    seconds = run_gyb(server, work_folder, options,
+                      ['-f', os.path.join(work_folder, 'no-backup'), '--action', 'estimate'])
+    record('estimate', seconds, len(mailbox.messages), mailbox_bytes(mailbox.messages))
+  if 'reindex' in options.scenarios:
+    seconds = run_gyb(server, work_folder, options, folder_args + ['--action', 'reindex'])
+    record('reindex', seconds, len(mailbox.messages))
+  if 'restore' in options.scenarios:
+    restore_mailbox = fakegmail.Mailbox()
+    restore_server = fakegmail.serve_in_thread(restore_mailbox, options.certfile, options.latency,
+                                               options.bandwidth)
+    seconds = run_gyb(restore_server, work_folder, options, folder_args + ['--action', 'restore'])
+    restore_server.shutdown()
+    if len(restore_mailbox.messages) != len(mailbox.messages):
+      print 'Error: restored %s of %s messages' % (len(restore_mailbox.messages), len(mailbox.messages))
+      sys.exit(1)
+    record('restore', seconds, len(restore_mailbox.messages), mailbox_bytes(restore_mailbox.messages))
+  server.shutdown()
+  return results
+
+def compare(results, baseline, tolerance):
+  '''
+  Returns:
+    list, the names of the scenarios slower than baseline by more than tolerance
+  '''
+  regressions = []
+  for scenario, result in sorted(results.items()):
+    if scenario not in baseline:
+      continue
+    before = baseline[scenario]['msgs_per_s']
+    change = (result['msgs_per_s'] - before) / before
+    regressed = change < -tolerance
+    print '%-12s %10.1f -> %10.1f msgs/s %+7.1f%%%s' % (
+        scenario, before, result['msgs_per_s'], change * 100, regressed and '  REGRESSION' or '')
+    if regressed:
+      regressions.append(scenario)
+  return regressions
+
+def main(argv):
+  parser = optparse.OptionParser(usage='usage: %prog [options] [-- gyb.py options]')
+  parser.add_option('--messages', type='int', default=1000,
+    help='number of messages in the mailbox (default 1000)')
+  parser.add_option('--new-messages', type='int', default=100,
+    help='number of messages that arrive before the incremental backup (default 100)')
+  parser.add_option('--seed', type='int', default=1,
+    help='seed of the mailbox generator (default 1)')
+  parser.add_option('--attachment-rate', type='float', default=0.1,
+    help='share of messages with a large attachment (default 0.1)')
+  parser.add_option('--latency', type='float', default=0,
+    help='seconds the server waits before answering each command')
+  parser.add_option('--bandwidth', type='int', default=0,
+    help='bytes per second the server sends at most')
+  parser.add_option('--certfile',
+    help='PEM file with a certificate and key to serve SSL, plaintext otherwise')
+  parser.add_option('--scenarios', default=','.join(SCENARIOS),
+    help='comma separated scenarios to run (default %s)' % ','.join(SCENARIOS))
+  parser.add_option('--stats-file',
+    help='passed to gyb.py to record the per stage timings of every scenario')
+  parser.add_option('--save',
+    help='write the results as JSON to this file')
+  parser.add_option('--compare',
+    help='compare the results with a file written by --save')
+  parser.add_option('--tolerance', type='float', default=0.15,
+    help='slowdown in msgs/s that counts as a regression with --compare (default 0.15)')
+  parser.add_option('--keep', action='store_true', default=False,
+    help='keep the work folder with the backup and gyb.py output')
+  options, args = parser.parse_args(argv)
+  options.scenarios = options.scenarios.split(',')
+  options.gyb_args = args
+  for scenario in options.scenarios:
+    if scenario not in SCENARIOS:
+      parser.error('unknown scenario %s' % scenario)
+  if options.stats_file:
+    options.stats_file = os.path.abspath(options.stats_file)
+  work_folder = tempfile.mkdtemp(prefix='gyb-bench-')
+  try:
+    results = run_scenarios(options, work_folder)
+  finally:
+    if options.keep:
+      print 'Work folder: %s' % work_folder
+    else:
+      shutil.rmtree(work_folder, True)
+  if options.save:
+    with open(options.save, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  if options.compare:
+    with open(options.compare) as f:
+      baseline = json.load(f)
+    if compare(results, baseline, options.tolerance):
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,640 @@
+#!/usr/bin/env python
+#
+# Local stand-in for the Gmail IMAP server, so GYB can be run and timed
+# without a Gmail account. It implements what gimaplib and gyb.py use:
+# XOAUTH (any token is accepted), CAPABILITY with X-GM-EXT-1, ID, XLIST,
+# COMPRESS=DEFLATE, CONDSTORE, UID SEARCH (X-GM-RAW, X-GM-LABELS, flags),
+# UID FETCH, APPEND with APPENDUID and UID STORE. Messages live in memory.
+#
+#   python benchmarks/fakegmail.py --messages 5000 --port 10143
+#   python gyb.py -e user@example.com -t key.txt --imap-host 127.0.0.1 \
+#       --imap-port 10143 --imap-plaintext
+#
+# where key.txt holds any two lines, the two legged OAuth key and secret.
+
+import SocketServer
+import base64
+import calendar
+import optparse
+import random
+import re
+import socket
+import ssl
+import sys
+import threading
+import time
+import zlib
+
+CAPABILITIES = ('IMAP4rev1 UNSELECT IDLE NAMESPACE QUOTA ID XLIST CHILDREN '
+                'X-GM-EXT-1 UIDPLUS COMPRESS=DEFLATE ENABLE MOVE CONDSTORE '
+                'ESEARCH UTF8=ACCEPT LIST-EXTENDED LIST-STATUS LITERAL- '
+                'SPECIAL-USE')
+
+SYSTEM_FOLDERS = (('\\AllMail', '[Gmail]/All Mail', None),
+                  ('\\Inbox', 'INBOX', '"\\\\Inbox"'),
+                  ('\\Sent', '[Gmail]/Sent Mail', '"\\\\Sent"'),
+                  ('\\Starred', '[Gmail]/Starred', '"\\\\Starred"'),
+                  ('\\Important', '[Gmail]/Important', '"\\\\Important"'),
+                  ('\\Drafts', '[Gmail]/Drafts', '"\\\\Draft"'))
+
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def imap_quote(s):
+  return '"' + s.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def label_token(name):
+  if re.match(r'^[A-Za-z0-9_.-]+$', name):
+    return name
+  return imap_quote(name)
+
+def internaldate(seconds):
+  t = time.gmtime(seconds)
+  return '"%02d-%s-%04d %02d:%02d:%02d +0000"' % (t.tm_mday,
+    MONTHS[t.tm_mon-1], t.tm_year, t.tm_hour, t.tm_min, t.tm_sec)
+
+def parse_internaldate(s):
+  m = re.match(r'\s*(\d+)-(\w+)-(\d+) (\d+):(\d+):(\d+) ([+-])(\d\d)(\d\d)', s)
+  day, mon, year, hh, mm, ss, sign, zh, zm = m.groups()
+  t = (int(year), MONTHS.index(mon)+1, int(day), int(hh), int(mm), int(ss),
+       0, 0, 0)
+  offset = (int(zh)*3600 + int(zm)*60) * (1 if sign == '+' else -1)
+  return calendar.timegm(t) - offset
+
+
+class Message(object):
+
+  __slots__ = ('uid', 'msgid', 'thrid', 'labels', 'flags', 'date', 'body',
+               'modseq', 'rfc822_msgid')
+
+  def __init__(self, uid, msgid, thrid, labels, flags, date, body, modseq):
+    self.uid = uid
+    self.msgid = msgid
+    self.thrid = thrid
+    self.labels = labels
+    self.flags = flags
+    self.date = date
+    self.body = body
+    self.modseq = modseq
+    m = re.search(r'(?im)^message-id:\s*(\S+)', body.split('\r\n\r\n', 1)[0])
+    self.rfc822_msgid = m and m.group(1) or None
+
+
+class Mailbox(object):
+
+  def __init__(self, uidvalidity=None):
+    self.lock = threading.RLock()
+    self.uidvalidity = uidvalidity or random.randint(1, 2**31)
+    self.messages = []
+    self.by_uid = {}
+    self.next_uid = 1
+    self.next_msgid = 1400000000000000000
+    self.modseq = 1000
+    self.labels = set()
+
+  def add(self, body, labels=(), flags=(), date=None):
+    with self.lock:
+      self.modseq += 1
+      msgid = self.next_msgid + self.next_uid * 17
+      m = Message(self.next_uid, msgid, msgid, list(labels), list(flags),
+                  date or int(time.time()), body, self.modseq)
+      self.next_uid += 1
+      self.messages.append(m)
+      self.by_uid[m.uid] = m
+      for l in labels:
+        if not l.startswith('"\\\\'):
+          self.labels.add(l)
+      return m
+
+  def touch(self, m):
+    self.modseq += 1
+    m.modseq = self.modseq
+
+
+WORDS = ('the quick brown fox jumps over lazy dog invoice meeting project '
+         'budget report please review attached thanks regards tomorrow '
+         'schedule update status deploy release customer ticket').split()
+
+def generate_mailbox(count, seed=1, label_count=20, attachment_rate=0.1,
+                     uidvalidity=None):
+  '''Fills a mailbox with synthetic messages of realistic sizes.
+
+  Plain text bodies follow a log-normal size distribution around 4KB and a
+  share of messages carry a base64 "attachment" that barely compresses.
+  Label use follows a Pareto distribution, so a few labels hold most
+  messages. The same seed always generates the same mailbox.
+  '''
+  rng = random.Random(seed)
+  mailbox = Mailbox(uidvalidity or rng.randint(1, 2**31))
+  user_labels = ['Label%d' % i for i in range(label_count)]
+  user_labels += ['"Project %d"' % i for i in range(label_count // 4)]
+  start = 1262304000
+  for i in xrange(count):
+    text_size = int(min(rng.lognormvariate(8.3, 1.0), 200000))
+    text = ' '.join(rng.choice(WORDS) for _ in xrange(text_size // 6))
+    parts = [
+      'From: sender%d@example.com' % rng.randint(1, 500),
+      'To: user@example.com',
+      'Subject: %s %d' % (' '.join(rng.sample(WORDS, 4)), i),
+      'Message-ID: <%d.%d@example.com>' % (i, seed),
+      'Date: Mon, 1 Jan 2010 00:00:00 +0000',
+      'MIME-Version: 1.0',
+    ]
+    if rng.random() < attachment_rate:
+      attachment_size = int(min(rng.lognormvariate(12.5, 1.2), 20000000))
+      blob = base64.encodestring(''.join(chr(rng.getrandbits(8))
+                                 for _ in xrange(min(attachment_size, 65536))))
+      blob = blob * (attachment_size // 65536 + 1)
+      blob = blob[:attachment_size * 4 // 3]
+      parts += ['Content-Type: multipart/mixed; boundary="b1"', '',
+                '--b1', 'Content-Type: text/plain', '', text,
+                '--b1', 'Content-Type: application/octet-stream',
+                'Content-Transfer-Encoding: base64', '', blob, '--b1--']
+    else:
+      parts += ['Content-Type: text/plain', '', text]
+    body = '\r\n'.join(parts).replace('\n', '\r\n').replace('\r\r\n', '\r\n')
+    labels = []
+    if rng.random() < 0.3:
+      labels.append('"\\\\Inbox"')
+    if rng.random() < 0.1:
+      labels.append('"\\\\Sent"')
+    for _ in range(rng.randint(0, 3)):
+      label = user_labels[int(rng.paretovariate(1.2)) % len(user_labels)]
+      if label not in labels:
+        labels.append(label)
+    flags = []
+    if rng.random() < 0.8:
+      flags.append('\\Seen')
+    if rng.random() < 0.05:
+      flags.append('\\Flagged')
+    mailbox.add(body, labels, flags, start + i * 3600)
+  return mailbox
+
+
+class Tokenizer(object):
+
+  token_re = re.compile(r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|(\x00\d+\x00)|([^\s()"]+))')
+
+  def __init__(self, line, literals):
+    self.line = line
+    self.literals = literals
+
+  def parse(self):
+    pos = 0
+    stack = [[]]
+    while True:
+      m = self.token_re.match(self.line, pos)
+      if not m or m.end() == pos:
+        break
+      pos = m.end()
+      lp, rp, quoted, literal, atom = m.groups()
+      if lp:
+        stack.append([])
+      elif rp:
+        inner = stack.pop()
+        stack[-1].append(inner)
+      elif quoted is not None:
+        stack[-1].append(re.sub(r'\\(.)', r'\1', quoted))
+      elif literal:
+        stack[-1].append(self.literals[int(literal.strip('\x00'))])
+      else:
+        stack[-1].append(atom)
+    while len(stack) > 1:
+      inner = stack.pop()
+      stack[-1].append(inner)
+    return stack[0]
+
+
+class Handler(SocketServer.BaseRequestHandler):
+
+  def setup(self):
+    self.mailbox = self.server.mailbox
+    self.buf = ''
+    self.decompressor = None
+    self.compressor = None
+    self.selected = False
+    self.condstore = False
+    self.out = []
+
+  # transport
+
+  def fill(self):
+    data = self.request.recv(65536)
+    if not data:
+      raise EOFError
+    if self.decompressor is not None:
+      data = self.decompressor.decompress(data)
+    self.buf += data
+
+  def readline(self):
+    while True:
+      i = self.buf.find('\n')
+      if i >= 0:
+        line, self.buf = self.buf[:i+1], self.buf[i+1:]
+        return line
+      self.fill()
+
+  def readexact(self, n):
+    while len(self.buf) < n:
+      self.fill()
+    data, self.buf = self.buf[:n], self.buf[n:]
+    return data
+
+  def write(self, data):
+    self.out.append(data)
+
+  def flush(self):
+    data = ''.join(self.out)
+    self.out = []
+    if not data:
+      return
+    if self.compressor is not None:
+      data = self.compressor.compress(data) + \
+             self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    bandwidth = self.server.bandwidth
+    if bandwidth:
+      step = 65536
+      for i in xrange(0, len(data), step):
+        chunk = data[i:i+step]
+        self.request.sendall(chunk)
+        time.sleep(len(chunk) / float(bandwidth))
+    else:
+      self.request.sendall(data)
+
+  def read_command(self):
+    line = self.readline()
+    literals = []
+    while True:
+      m = re.search(r'\{(\d+)(\+?)\}\r?\n$', line)
+      if not m:
+        break
+      size = int(m.group(1))
+      if not m.group(2):
+        self.write('+ go ahead\r\n')
+        self.flush()
+      literals.append(self.readexact(size))
+      line = line[:m.start()] + '\x00%d\x00' % (len(literals)-1) + \
+             self.readline()
+    return line.rstrip('\r\n'), literals
+
+  def handle(self):
+    self.write('* OK Gimap ready for requests from 127.0.0.1\r\n')
+    self.flush()
+    try:
+      while True:
+        line, literals = self.read_command()
+        parts = line.split(' ', 2)
+        if len(parts) < 2:
+          self.write('* BAD invalid command\r\n')
+          self.flush()
+          continue
+        tag, command = parts[0], parts[1].upper()
+        rest = len(parts) > 2 and parts[2] or ''
+        if self.server.latency:
+          time.sleep(self.server.latency)
+        method = getattr(self, 'cmd_' + command.replace('-', '_'), None)
+        if method is None:
+          self.write('%s BAD Unknown command\r\n' % tag)
+        else:
+          try:
+            if method(tag, rest, literals) is False:
+              return
+          except (ValueError, IndexError, KeyError, AttributeError), e:
+            self.write('%s BAD %s\r\n' % (tag, e))
+        self.flush()
+    except (EOFError, socket.error, ssl.SSLError):
+      return
+
+  # commands
+
+  def cmd_CAPABILITY(self, tag, rest, literals):
+    self.write('* CAPABILITY %s\r\n' % CAPABILITIES)
+    self.write('%s OK Success\r\n' % tag)
+
+  def cmd_AUTHENTICATE(self, tag, rest, literals):
+    self.write('+ \r\n')
+    self.flush()
+    self.readline()
+    self.write('* CAPABILITY %s\r\n' % CAPABILITIES)
+    self.write('%s OK user@example.com authenticated (Success)\r\n' % tag)
+
+  def cmd_LOGIN(self, tag, rest, literals):
+    self.write('%s OK authenticated (Success)\r\n' % tag)
+
+  def cmd_ID(self, tag, rest, literals):
+    self.write('* ID ("name" "GImap" "vendor" "Google, Inc.")\r\n')
+    self.write('%s OK Success\r\n' % tag)
+
+  def cmd_NOOP(self, tag, rest, literals):
+    self.write('%s OK Success\r\n' % tag)
+
+  def cmd_ENABLE(self, tag, rest, literals):
+    if 'CONDSTORE' in rest.upper():
+      self.condstore = True
+      self.write('* ENABLED CONDSTORE\r\n')
+    self.write('%s OK Success\r\n' % tag)
+
+  def cmd_COMPRESS(self, tag, rest, literals):
+    self.write('%s OK Success\r\n' % tag)
+    self.flush()
+    self.decompressor = zlib.decompressobj(-15)
+    self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                       zlib.DEFLATED, -15)
+    if self.buf:
+      self.buf = self.decompressor.decompress(self.buf)
+
+  def cmd_XLIST(self, tag, rest, literals, verb='XLIST'):
+    for flag, name, token in SYSTEM_FOLDERS:
+      self.write('* %s (\\HasNoChildren %s) "/" %s\r\n' %
+                 (verb, flag, imap_quote(name)))
+    with self.mailbox.lock:
+      labels = sorted(self.mailbox.labels)
+    for label in labels:
+      name = label.strip('"')
+      self.write('* %s (\\HasNoChildren) "/" %s\r\n' %
+                 (verb, imap_quote(name)))
+    self.write('%s OK Success\r\n' % tag)
+
+  def cmd_LIST(self, tag, rest, literals):
+    return self.cmd_XLIST(tag, rest, literals, 'LIST')
+
+  def cmd_SELECT(self, tag, rest, literals, readonly=False):
+    if 'CONDSTORE' in rest.upper():
+      self.condstore = True
+    mb = self.mailbox
+    with mb.lock:
+      self.write('* FLAGS (\\Answered \\Flagged \\Draft \\Deleted \\Seen)\r\n')
+      self.write('* OK [UIDVALIDITY %d] UIDs valid.\r\n' % mb.uidvalidity)
+      self.write('* %d EXISTS\r\n' % len(mb.messages))
+      self.write('* 0 RECENT\r\n')
+      self.write('* OK [UIDNEXT %d] Predicted next UID.\r\n' % mb.next_uid)
+      self.write('* OK [HIGHESTMODSEQ %d]\r\n' % mb.modseq)
+    self.selected = True
+    self.write('%s OK [%s] [Gmail]/All Mail selected. (Success)\r\n' %
+               (tag, readonly and 'READ-ONLY' or 'READ-WRITE'))
+
+  def cmd_EXAMINE(self, tag, rest, literals):
+    return self.cmd_SELECT(tag, rest, literals, True)
+
+  def cmd_LOGOUT(self, tag, rest, literals):
+    self.write('* BYE LOGOUT Requested\r\n')
+    self.write('%s OK 73 good day (Success)\r\n' % tag)
+    self.flush()
+    return False
+
+  def cmd_APPEND(self, tag, rest, literals):
+    args = Tokenizer(rest, literals).parse()
+    body = args[-1]
+    flags, date = [], None
+    for arg in args[1:-1]:
+      if isinstance(arg, list):
+        flags = arg
+      else:
+        date = parse_internaldate(arg)
+    m = self.mailbox.add(body, (), flags, date)
+    self.write('%s OK [APPENDUID %d %d] (Success)\r\n' %
+               (tag, self.mailbox.uidvalidity, m.uid))
+
+  def cmd_UID(self, tag, rest, literals):
+    sub, _, args = rest.partition(' ')
+    sub = sub.upper()
+    if sub == 'FETCH':
+      return self.fetch(tag, args, True)
+    elif sub == 'SEARCH':
+      return self.search(tag, args, literals)
+    elif sub == 'STORE':
+      return self.store(tag, args, literals)
+    self.write('%s BAD Unknown UID command\r\n' % tag)
+
+  def cmd_FETCH(self, tag, rest, literals):
+    return self.fetch(tag, rest, False)
+
+  def resolve(self, seqset, by_uid):
+    mb = self.mailbox
+    if by_uid:
+      top = mb.messages and mb.messages[-1].uid or 0
+    else:
+      top = len(mb.messages)
+    result = []
+    for part in seqset.split(','):
+      if ':' in part:
+        a, b = part.split(':')
+        a = top if a == '*' else int(a)
+        b = top if b == '*' else int(b)
+        if a > b:
+          a, b = b, a
+      else:
+        a = b = top if part == '*' else int(part)
+      if by_uid:
+        if b - a > len(mb.messages):
+          result.extend(m for m in mb.messages if a <= m.uid <= b)
+        else:
+          result.extend(mb.by_uid[u] for u in xrange(a, b+1)
+                        if u in mb.by_uid)
+      else:
+        result.extend(mb.messages[a-1:b])
+    return result
+
+  def fetch(self, tag, args, by_uid):
+    seqset, _, items = args.partition(' ')
+    changedsince = None
+    m = re.search(r'\(CHANGEDSINCE (\d+)\)\s*$', items)
+    if m:
+      changedsince = int(m.group(1))
+      items = items[:m.start()].strip()
+      self.condstore = True
+    items = items.strip('()').upper().split()
+    mb = self.mailbox
+    with mb.lock:
+      messages = self.resolve(seqset, by_uid)
+      seqnums = dict((id(msg), i+1) for i, msg in enumerate(mb.messages)) \
+                if not by_uid else None
+    for msg in messages:
+      if changedsince is not None and msg.modseq <= changedsince:
+        continue
+      out = []
+      if 'X-GM-THRID' in items:
+        out.append('X-GM-THRID %d' % msg.thrid)
+      if 'X-GM-MSGID' in items:
+        out.append('X-GM-MSGID %d' % msg.msgid)
+      if 'X-GM-LABELS' in items:
+        out.append('X-GM-LABELS (%s)' % ' '.join(msg.labels))
+      if by_uid or 'UID' in items:
+        out.append('UID %d' % msg.uid)
+      if self.condstore or 'MODSEQ' in items:
+        out.append('MODSEQ (%d)' % msg.modseq)
+      if 'RFC822.SIZE' in items:
+        out.append('RFC822.SIZE %d' % len(msg.body))
+      if 'INTERNALDATE' in items:
+        out.append('INTERNALDATE %s' % internaldate(msg.date))
+      if 'FLAGS' in items:
+        out.append('FLAGS (%s)' % ' '.join(msg.flags))
+      seq = by_uid and mb.messages.index(msg)+1 or seqnums[id(msg)]
+      header_item = [i for i in items if i.startswith('BODY.PEEK[HEADER')]
+      if 'BODY.PEEK[]' in items or 'BODY[]' in items:
+        out.append('BODY[] {%d}\r\n%s' % (len(msg.body), msg.body))
+      elif header_item:
+        header = msg.body.split('\r\n\r\n', 1)[0] + '\r\n\r\n'
+        out.append('BODY[HEADER.FIELDS (FROM TO SUBJECT MESSAGE-ID)] '
+                   '{%d}\r\n%s' % (len(header), header))
+      self.write('* %d FETCH (%s)\r\n' % (seq, ' '.join(out)))
+      if sum(len(x) for x in self.out) > 1048576:
+        self.flush()
+    self.write('%s OK Success\r\n' % tag)
+
+  def search(self, tag, args, literals):
+    tokens = Tokenizer(args, literals).parse()
+    mb = self.mailbox
+    with mb.lock:
+      result = list(mb.messages)
+      i = 0
+      while i < len(tokens):
+        key = tokens[i]
+        ukey = isinstance(key, str) and key.upper() or ''
+        if ukey == 'X-GM-RAW':
+          result = self.raw_search(result, tokens[i+1])
+          i += 2
+        elif ukey == 'X-GM-LABELS':
+          label = tokens[i+1]
+          if label.startswith('\\'):
+            label = '"\\\\%s"' % label[1:]
+          result = [x for x in result
+                    if label in x.labels or
+                       label_token(label) in x.labels or
+                       imap_quote(label) in x.labels]
+          i += 2
+        elif ukey == 'UID':
+          uids = set(x.uid for x in self.resolve(tokens[i+1], True))
+          result = [x for x in result if x.uid in uids]
+          i += 2
+        elif ukey == 'KEYWORD':
+          result = [x for x in result if tokens[i+1] in x.flags]
+          i += 2
+        elif ukey in ('SEEN', 'FLAGGED', 'ANSWERED', 'DRAFT', 'DELETED'):
+          flag = '\\' + ukey.capitalize()
+          result = [x for x in result if flag in x.flags]
+          i += 1
+        elif ukey == 'ALL':
+          i += 1
+        else:
+          i += 1
+      uids = ' '.join(str(x.uid) for x in result)
+    self.write('* SEARCH %s\r\n' % uids if uids else '* SEARCH\r\n')
+    self.write('%s OK SEARCH completed (Success)\r\n' % tag)
+
+  def raw_search(self, messages, query):
+    '''Supports the Gmail search operators GYB sends: rfc822msgid:,
+    after:, before:, label: and l:. in:anywhere and others match all.'''
+    for term in query.split():
+      operator, _, value = term.partition(':')
+      operator = operator.lower()
+      if operator == 'rfc822msgid':
+        if not value.startswith('<'):
+          value = '<%s>' % value
+        messages = [x for x in messages if x.rfc822_msgid == value]
+      elif operator in ('after', 'before'):
+        seconds = calendar.timegm(time.strptime(value, '%Y/%m/%d'))
+        if operator == 'after':
+          messages = [x for x in messages if x.date >= seconds]
+        else:
+          messages = [x for x in messages if x.date < seconds]
+      elif operator in ('label', 'l'):
+        tokens = (label_token(value), imap_quote(value),
+                  label_token(value.replace('-', ' ')), imap_quote(value.replace('-', ' ')))
+        messages = [x for x in messages if any(t in x.labels for t in tokens)]
+    return messages
+
+  def store(self, tag, args, literals):
+    seqset, item, value = args.split(' ', 2)
+    values = Tokenizer(value, literals).parse()
+    if values and isinstance(values[0], list):
+      values = values[0]
+    mb = self.mailbox
+    with mb.lock:
+      messages = self.resolve(seqset, True)
+      for msg in messages:
+        if item.upper().endswith('X-GM-LABELS'):
+          target = msg.labels
+          values_fmt = []
+          for v in values:
+            if v.startswith('\\'):
+              values_fmt.append('"\\\\%s"' % v[1:])
+            else:
+              values_fmt.append(label_token(v))
+              mb.labels.add(label_token(v))
+        else:
+          target = msg.flags
+          values_fmt = values
+        if item.startswith('+'):
+          for v in values_fmt:
+            if v not in target:
+              target.append(v)
+        elif item.startswith('-'):
+          for v in values_fmt:
+            if v in target:
+              target.remove(v)
+        else:
+          target[:] = values_fmt
+        mb.touch(msg)
+    self.write('%s OK Success\r\n' % tag)
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+  allow_reuse_address = True
+  daemon_threads = True
+
+  def __init__(self, address, mailbox, certfile=None, latency=0,
+               bandwidth=0):
+    self.mailbox = mailbox
+    self.certfile = certfile
+    self.latency = latency
+    self.bandwidth = bandwidth
+    SocketServer.TCPServer.__init__(self, address, Handler)
+
+  def get_request(self):
+    sock, addr = self.socket.accept()
+    # answer every command at once, like a server flushing each response
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if self.certfile:
+      sock = ssl.wrap_socket(sock, server_side=True, certfile=self.certfile)
+    return sock, addr
+
+
+def serve_in_thread(mailbox, certfile=None, latency=0, bandwidth=0, port=0):
+  server = Server(('127.0.0.1', port), mailbox, certfile, latency, bandwidth)
+  t = threading.Thread(target=server.serve_forever)
+  t.daemon = True
+  t.start()
+  return server
+
+def main(argv):
+  parser = optparse.OptionParser(usage='usage: %prog [options]')
+  parser.add_option('--messages', type='int', default=1000,
+    help='number of synthetic messages in the mailbox (default 1000)')
+  parser.add_option('--seed', type='int', default=1,
+    help='seed of the mailbox generator (default 1)')
+  parser.add_option('--attachment-rate', type='float', default=0.1,
+    help='share of messages with a large attachment (default 0.1)')
+  parser.add_option('--port', type='int', default=10143,
+    help='port to listen on at 127.0.0.1 (default 10143)')
+  parser.add_option('--certfile',
+    help='PEM file with a certificate and key to serve SSL, plaintext otherwise')
+  parser.add_option('--latency', type='float', default=0,
+    help='seconds to wait before answering each command')
+  parser.add_option('--bandwidth', type='int', default=0,
+    help='bytes per second the server sends at most')
+  options, args = parser.parse_args(argv)
+  print 'Generating %s messages...' % options.messages
+  mailbox = generate_mailbox(options.messages, options.seed,
+                             attachment_rate=options.attachment_rate)
+  server = Server(('127.0.0.1', options.port), mailbox, options.certfile,
+                  options.latency, options.bandwidth)
+  print 'Serving %s on 127.0.0.1:%s' % (options.certfile and 'SSL' or 'plaintext', options.port)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
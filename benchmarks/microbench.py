@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+#
+# Microbenchmarks of the work GYB does for every backed up message, each
+# step timed in isolation and end to end on synthetic FETCH responses:
+#
+#   parse_envelope  gimaplib.GImapParseFetchResponse() of the FETCH items
+#   split_labels    shlex.split() of X-GM-LABELS
+#   internaldate    imaplib.Internaldate2tuple() -> time.mktime() -> datetime
+#   parse_flags     imaplib.ParseFlags()
+#   parse_headers   email.parser.HeaderParser.parsestr() of the headers
+#   sqlite_insert   gyb.record_message_batch() into an in-memory database
+#   end_to_end      gyb.save_message() to a temporary folder plus the insert
+#
+# The profiles vary the message size and the number of labels. Every step
+# reports the best ns/message of --repeat runs and the gc tracked objects its
+# results keep alive per message. Python 2 has no allocation counter, so this
+# is only a proxy: strings and dicts holding only strings are not tracked.
+#
+#   python benchmarks/microbench.py --save baseline.json
+#   python benchmarks/microbench.py --compare baseline.json --tolerance 0.2
+#
+# With --compare the exit status is 1 if a step got slower than the baseline
+# by more than --tolerance.
+
+import datetime
+import email.parser
+import gc
+import imaplib
+import json
+import optparse
+import os
+import shlex
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import fakegmail
+import gimaplib
+import gyb
+
+# name: (attachment rate, label count of the mailbox, labels added per message)
+PROFILES = {'small': (0.0, 20, 0),
+            'labels': (0.0, 40, 20),
+            'attachments': (0.5, 20, 0)}
+
+def fetch_responses(profile, count, seed):
+  '''
+  Returns:
+    list, (envelope, message) tuples as imaplib returns them for
+    UID FETCH (X-GM-LABELS X-GM-MSGID X-GM-THRID INTERNALDATE FLAGS BODY.PEEK[])
+  '''
+  attachment_rate, label_count, extra_labels = PROFILES[profile]
+  mailbox = fakegmail.generate_mailbox(count, seed, label_count, attachment_rate)
+  responses = []
+  for sequence, message in enumerate(mailbox.messages, 1):
+    labels = list(message.labels)
+    labels += ['"Extra Label %d"' % i for i in range(extra_labels)]
+    envelope = ('%d (X-GM-THRID %d X-GM-MSGID %d X-GM-LABELS (%s) UID %d '
+                'INTERNALDATE %s FLAGS (%s) BODY[] {%d}' % (
+                sequence, message.thrid, message.msgid, ' '.join(labels), message.uid,
+                fakegmail.internaldate(message.date), ' '.join(message.flags), len(message.body)))
+    responses.append((envelope, message.body))
+  return responses
+
+def new_database():
+  sqlconn = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+  sqlconn.text_factory = str
+  sqlcur = sqlconn.cursor()
+  gyb.initializeDB(sqlcur, sqlconn, 'user@example.com', '1')
+  return sqlconn, sqlcur
+
+def make_steps(responses, work_folder):
+  '''
+  Returns:
+    list, (name, function) tuples. Each function runs the step over all
+    responses and returns its results so they stay allocated.
+  '''
+  header_parser = email.parser.HeaderParser()
+  envelopes = [envelope for envelope, message in responses]
+  items = [gimaplib.GImapParseFetchResponse(envelope) for envelope in envelopes]
+  headers = [message.split('\r\n\r\n', 1)[0] + '\r\n\r\n' for envelope, message in responses]
+  saved_messages = [gyb.save_message(envelope, (message,), work_folder, '1', header_parser)
+                    for envelope, message in responses]
+
+  def parse_envelope():
+    return [gimaplib.GImapParseFetchResponse(envelope) for envelope in envelopes]
+  def split_labels():
+    return [shlex.split(fetch_items['X-GM-LABELS'][1:-1], posix=False) for fetch_items in items]
+  def internaldate():
+    return [datetime.datetime.fromtimestamp(time.mktime(
+              imaplib.Internaldate2tuple('INTERNALDATE ' + fetch_items['INTERNALDATE'])))
+            for fetch_items in items]
+  def parse_flags():
+    return [imaplib.ParseFlags('FLAGS ' + fetch_items['FLAGS']) for fetch_items in items]
+  def parse_headers():
+    return [header_parser.parsestr(header, True) for header in headers]
+  def sqlite_insert():
+    sqlconn, sqlcur = new_database()
+    gyb.record_message_batch(sqlcur, saved_messages)
+    sqlconn.commit()
+    return sqlconn
+  def end_to_end():
+    sqlconn, sqlcur = new_database()
+    saved = [gyb.save_message(envelope, (message,), work_folder, '1', header_parser)
+             for envelope, message in responses]
+    gyb.record_message_batch(sqlcur, saved)
+    sqlconn.commit()
+    return sqlconn, saved
+  return [('parse_envelope', parse_envelope),
+          ('split_labels', split_labels),
+          ('internaldate', internaldate),
+          ('parse_flags', parse_flags),
+          ('parse_headers', parse_headers),
+          ('sqlite_insert', sqlite_insert),
+          ('end_to_end', end_to_end)]
+
+def measure(function, count, repeat):
+  '''
+  Returns:
+    tuple, the best ns per message of repeat runs and the gc tracked
+    objects per message left by one run
+  '''
+  best = None
+  gc.collect()
+  gc.disable()
+  try:
+    for run in range(repeat):
+      started = time.time()
+      function()
+      seconds = time.time() - started
+      if best is None or seconds < best:
+        best = seconds
+      gc.collect()
+    objects_before = len(gc.get_objects())
+    results = function()
+    objects = len(gc.get_objects()) - objects_before - 1
+    del results
+  finally:
+    gc.enable()
+  return best * 1e9 / count, float(objects) / count
+
+def compare(results, baseline, tolerance):
+  '''
+  Returns:
+    list, the profile/step names slower than baseline by more than tolerance
+  '''
+  regressions = []
+  for name, result in sorted(results.items()):
+    if name not in baseline:
+      continue
+    before = baseline[name]['ns_per_msg']
+    change = (result['ns_per_msg'] - before) / before
+    regressed = change > tolerance
+    print '%-28s %12.0f -> %12.0f ns/msg %+7.1f%%%s' % (
+        name, before, result['ns_per_msg'], change * 100, regressed and '  REGRESSION' or '')
+    if regressed:
+      regressions.append(name)
+  return regressions
+
+def main(argv):
+  parser = optparse.OptionParser(usage='usage: %prog [options]')
+  parser.add_option('--messages', type='int', default=2000,
+    help='number of FETCH responses per profile (default 2000)')
+  parser.add_option('--repeat', type='int', default=5,
+    help='runs of every step, the best one counts (default 5)')
+  parser.add_option('--seed', type='int', default=1,
+    help='seed of the message generator (default 1)')
+  parser.add_option('--profiles', default=','.join(sorted(PROFILES)),
+    help='comma separated profiles to run (default %s)' % ','.join(sorted(PROFILES)))
+  parser.add_option('--save',
+    help='write the results as JSON to this file')
+  parser.add_option('--compare',
+    help='compare the results with a file written by --save')
+  parser.add_option('--tolerance', type='float', default=0.2,
+    help='slowdown in ns/msg that counts as a regression with --compare (default 0.2)')
+  options, args = parser.parse_args(argv)
+  results = {}
+  work_folder = tempfile.mkdtemp(prefix='gyb-microbench-')
+  try:
+    for profile in options.profiles.split(','):
+      if profile not in PROFILES:
+        parser.error('unknown profile %s' % profile)
+      responses = fetch_responses(profile, options.messages, options.seed)
+      average_size = sum(len(message) for envelope, message in responses) / len(responses)
+      print '%s: %s messages of %s bytes on average' % (profile, len(responses), average_size)
+      for step, function in make_steps(responses, work_folder):
+        ns_per_msg, objects_per_msg = measure(function, len(responses), options.repeat)
+        results['%s/%s' % (profile, step)] = {'ns_per_msg': round(ns_per_msg),
+                                              'objects_per_msg': round(objects_per_msg, 1)}
+        print '  %-16s %12.0f ns/msg %8.1f objects/msg' % (step, ns_per_msg, objects_per_msg)
+  finally:
+    shutil.rmtree(work_folder, True)
+  if options.save:
+    with open(options.save, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  if options.compare:
+    with open(options.compare) as f:
+      baseline = json.load(f)
+    if compare(results, baseline, options.tolerance):
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -1,13 +1,18 @@
 # Functions that make IMAP behave more Gmail-ish
 
+import array
+import bisect
 import imaplib
 import re
 import shlex
+import socket
 import sys
-import cStringIO
+import threading
+import time
 import zlib
 
 import gyb
+import perfstats
 
 maxRead = 1000000
 class MySSL (imaplib.IMAP4_SSL):
@@ -19,66 +24,140 @@ class MySSL (imaplib.IMAP4_SSL):
       self.raw_out = 0
       self.full_in = 0
       self.full_out = 0
+      self.read_size = 65536
+      self.wait_time = 0.0
+      self.decompress_time = 0.0
+      self.compress_time = 0.0
+      self.read_buffer = bytearray()
+      self.read_pos = 0
       imaplib.IMAP4_SSL.__init__(self, host, port)
 
-  def start_compressing(self):
+  def start_compressing(self, level=zlib.Z_DEFAULT_COMPRESSION):
       """start_compressing()
       Enable deflate compression on the socket (RFC 4978)."""
   
       # rfc 1951 - pure DEFLATE, so use -15 for both windows
       self.decompressor = zlib.decompressobj(-15)
-      self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+      self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+      self.compress_level = level
+      # anything read past the COMPRESS response is already compressed
+      pending = str(self.read_buffer[self.read_pos:])
+      del self.read_buffer[:]
+      self.read_pos = 0
+      if pending:
+        self.full_in -= len(pending)
+        data = self.decompressor.decompress(pending)
+        self.full_in += len(data)
+        self.read_buffer += data
+
+  def set_compress_level(self, level):
+      """set_compress_level(level)
+      Change the deflate level of the data we send."""
+      if self.compressor is None or level == self.compress_level:
+        return
+      # every send() ends with a sync flush and no final block, so a fresh
+      # compressor just continues the stream without the old window
+      self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+      self.compress_level = level
+
+  def _ssl_read(self):
+      with perfstats.timer('network_read'):
+        started = time.time()
+        data = self.sslobj.read(self.read_size)
+        self.wait_time += time.time() - started
+      perfstats.count('net_bytes_in', len(data))
+      return data
   
-  def read(self, size):
-      """Read 'size' bytes from remote."""
-      # sslobj.read() sometimes returns < size bytes
-      chunks = cStringIO.StringIO()
-      read = 0
-      while read < size:
-        data = self.read2(min(size-read, 16384))
-        read += len(data)
-        chunks.write(data)
-
-      chunks.seek(0)
-      return chunks.read()
-
-  def read2(self, size):
-      """data = read(size)
-      Read at most 'size' bytes from remote."""
+  def _raw_read(self):
+      """data = _raw_read()
+      Read the next chunk of (decompressed) data from remote, '' on EOF."""
       if self.decompressor is None:
-        data = self.sslobj.read(size)
+        data = self._ssl_read()
         self.raw_in += len(data)
         self.full_in += len(data)
         return data
-  
-      if self.decompressor.unconsumed_tail:
-        data = self.decompressor.unconsumed_tail
-      else:
-        data = self.sslobj.read(8192)
-        self.raw_in += len(data)
-      data = self.decompressor.decompress(data, size)
-      self.full_in += len(data)
-      return data
+
+      while True:
+        if self.decompressor.unconsumed_tail:
+          data = self.decompressor.unconsumed_tail
+        else:
+          data = self._ssl_read()
+          if not data:
+            return data
+          self.raw_in += len(data)
+        # a sync flush block decompresses to nothing, keep reading
+        with perfstats.timer('decompress'):
+          started = time.time()
+          data = self.decompressor.decompress(data, self.read_size)
+          self.decompress_time += time.time() - started
+        if data:
+          self.full_in += len(data)
+          return data
+
+  def _fill(self):
+      """Append the next chunk from remote to the read buffer, False on EOF."""
+      data = self._raw_read()
+      if not data:
+        return False
+      if self.read_pos:
+        del self.read_buffer[:self.read_pos]
+        self.read_pos = 0
+      self.read_buffer += data
+      return True
+
+  def read(self, size):
+      """Read 'size' bytes from remote, fewer only on EOF."""
+      available = len(self.read_buffer) - self.read_pos
+      if available >= size:
+        data = str(self.read_buffer[self.read_pos:self.read_pos+size])
+        self.read_pos += size
+        return data
+      # large literals are joined from the raw chunks instead of growing the buffer
+      chunks = [str(self.read_buffer[self.read_pos:])]
+      del self.read_buffer[:]
+      self.read_pos = 0
+      while available < size:
+        data = self._raw_read()
+        if not data:
+          break
+        chunks.append(data)
+        available += len(data)
+      if available > size:
+        extra = available - size
+        self.read_buffer += chunks[-1][-extra:]
+        chunks[-1] = chunks[-1][:-extra]
+      return ''.join(chunks)
 
   def readline(self):
-      """Read line from remote."""
-      line = cStringIO.StringIO()
-      while 1:
-        char = self.read(1)
-        line.write(char)
-        if char in ("\n", ""): 
-          line.seek(0)
-          return line.read()
-  
+      """Read line from remote, without the line ending only on EOF."""
+      start = self.read_pos
+      while True:
+        end = self.read_buffer.find('\n', start)
+        if end >= 0:
+          line = str(self.read_buffer[self.read_pos:end+1])
+          self.read_pos = end + 1
+          return line
+        start = len(self.read_buffer) - self.read_pos
+        if not self._fill():
+          line = str(self.read_buffer[self.read_pos:])
+          del self.read_buffer[:]
+          self.read_pos = 0
+          return line
+        start += self.read_pos
+
   def send(self, data):
       """send(data)
       Send 'data' to remote."""
       self.full_out += len(data)
       if self.compressor is not None:
+        started = time.time()
         data = self.compressor.compress(data)
         data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.compress_time += time.time() - started
       self.raw_out += len(data)
-      self.sslobj.sendall(data)
+      perfstats.count('net_bytes_out', len(data))
+      with perfstats.timer('network_write'):
+        self.sslobj.sendall(data)
 
   def display_stats(self):
       if self.compressor is not None:
@@ -89,6 +168,241 @@ class MySSL (imaplib.IMAP4_SSL):
         print "full out ", self.full_out
         print "ratio = %d%%" % (100*(self.full_out-self.raw_out)/self.full_out)
         print "Compression efficiency: %d%%" % (100*(self.full_in+self.full_out-self.raw_in-self.raw_out)/(self.full_in+self.full_out))
+        print "decompress time %.2fs, compress time %.2fs, network wait %.2fs" % (
+            self.decompress_time, self.compress_time, self.wait_time)
+
+class PlainSocket(object):
+  '''Gives a plain socket the read() and sendall() of an SSL socket.'''
+
+  def __init__(self, sock):
+    self.sock = sock
+
+  def read(self, size):
+    return self.sock.recv(size)
+
+  def sendall(self, data):
+    self.sock.sendall(data)
+
+class MyPlain (MySSL):
+  '''MySSL over an unencrypted connection, only meant for local test servers.'''
+
+  def open(self, host='', port=imaplib.IMAP4_PORT):
+      self.host = host
+      self.port = port
+      self.sock = socket.create_connection((host, port))
+      self.sslobj = PlainSocket(self.sock)
+      self.file = self.sock.makefile('rb')
+
+class CompressionTuner(object):
+  '''Decides whether COMPRESS=DEFLATE pays off for a session.
+
+  sample() is called with a connection after every batch. Once a connection
+  has received min_sample decompressed bytes since its last decision, the
+  network time compression saved (the bytes it saved at the measured link
+  rate) is compared to the time spent decompressing them. When compression
+  saves less than min_ratio percent or costs more CPU time than it saves,
+  the link is not the bottleneck: the tuner disables compression and the
+  caller should reconnect without it. Otherwise the decompression read size
+  and the deflate level of the data we send are tuned to the measured ratios.
+  '''
+
+  min_sample = 4194304
+  min_ratio = 10
+
+  def __init__(self):
+    self.enabled = True
+    self.decision = None
+    self.lock = threading.Lock()
+    self.windows = {}
+
+  def sample(self, imapconn):
+    '''
+    Args:
+      imapconn: object, a MySSL connection
+
+    Returns:
+      bool, True if the connection is compressed while compression is disabled
+      and should be replaced by a connection without COMPRESS
+    '''
+    if imapconn.decompressor is None:
+      return False
+    with self.lock:
+      if not self.enabled:
+        return True
+      counters = (imapconn.raw_in, imapconn.full_in, imapconn.raw_out, imapconn.full_out,
+                  imapconn.wait_time, imapconn.decompress_time)
+      start = self.windows.setdefault(id(imapconn), counters)
+      raw_in, full_in, raw_out, full_out, wait_time, decompress_time = [
+          now - then for now, then in zip(counters, start)]
+      if full_in < self.min_sample:
+        return False
+      self.windows[id(imapconn)] = counters
+      ratio = 100 * (full_in - raw_in) / full_in
+      # seconds the link would have needed for the bytes compression saved
+      saved_time = wait_time * (full_in - raw_in) / max(raw_in, 1)
+      reason = 'ratio %d%%, saved %.2fs of network time for %.2fs of decompression' % (
+          ratio, saved_time, decompress_time)
+      # what each decision was based on, for --stats-file
+      perfstats.count('compression_sampled_bytes', full_in)
+      perfstats.count('compression_saved_bytes', full_in - raw_in)
+      perfstats.count('compression_saved_seconds', saved_time)
+      perfstats.count('compression_decompress_seconds', decompress_time)
+      if ratio < self.min_ratio or decompress_time > saved_time:
+        self.enabled = False
+        self.decision = 'disabled, %s' % reason
+        perfstats.count('compression_disabled')
+        print '\nNetwork compression %s' % self.decision
+        return True
+      self.decision = 'enabled, %s' % reason
+      perfstats.count('compression_enabled')
+      # well compressed data expands a lot, fewer and larger reads are cheaper
+      if ratio >= 50:
+        imapconn.read_size = 262144
+      else:
+        imapconn.read_size = 65536
+      if full_out and 100 * (full_out - raw_out) / full_out < self.min_ratio:
+        imapconn.set_compress_level(zlib.Z_BEST_SPEED)
+      else:
+        imapconn.set_compress_level(zlib.Z_DEFAULT_COMPRESSION)
+      return False
+
+  def display_stats(self):
+    print "Adaptive compression: %s" % (self.decision or 'not enough data to decide')
+
+class UIDSet(object):
+  '''A sorted set of IMAP UIDs stored in an array of unsigned ints.
+
+  A million UIDs take 4MB instead of the tens of MB of a list of strings, and
+  the set is sent to the server as a compact sequence set like 1:500,502,510:900
+  instead of every UID.
+  '''
+
+  def __init__(self, uids=()):
+    if isinstance(uids, UIDSet):
+      self.uids = array.array('I', uids.uids)
+    else:
+      self.uids = array.array('I', sorted(set(int(uid) for uid in uids)))
+
+  @classmethod
+  def from_sorted(cls, uids):
+    '''Makes a set from an array('I') of UIDs that is already sorted and unique.'''
+    uid_set = cls()
+    uid_set.uids = uids
+    return uid_set
+
+  @classmethod
+  def from_imap(cls, sequence_set):
+    '''Makes a set from an IMAP sequence set like 1:500,502 (without *).'''
+    uids = []
+    for part in sequence_set.split(','):
+      if ':' in part:
+        first, last = sorted(int(uid) for uid in part.split(':'))
+        uids.extend(xrange(first, last + 1))
+      elif part:
+        uids.append(int(part))
+    return cls(uids)
+
+  def __len__(self):
+    return len(self.uids)
+
+  def __iter__(self):
+    return iter(self.uids)
+
+  def __contains__(self, uid):
+    i = bisect.bisect_left(self.uids, int(uid))
+    return i < len(self.uids) and self.uids[i] == int(uid)
+
+  def __eq__(self, other):
+    return isinstance(other, UIDSet) and self.uids == other.uids
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return 'UIDSet(%r)' % self.to_imap()
+
+  def max(self):
+    if not self.uids:
+      return None
+    return self.uids[-1]
+
+  def above(self, uid):
+    '''Returns the UIDs greater than uid.'''
+    return UIDSet.from_sorted(self.uids[bisect.bisect_right(self.uids, uid):])
+
+  def difference(self, other):
+    '''Returns the UIDs not in other, a UIDSet.'''
+    result = array.array('I')
+    other_uids = other.uids
+    other_count = len(other_uids)
+    j = 0
+    for uid in self.uids:
+      while j < other_count and other_uids[j] < uid:
+        j += 1
+      if j == other_count or other_uids[j] != uid:
+        result.append(uid)
+    return UIDSet.from_sorted(result)
+
+  def intersection(self, other):
+    '''Returns the UIDs also in other, a UIDSet.'''
+    result = array.array('I')
+    other_uids = other.uids
+    other_count = len(other_uids)
+    j = 0
+    for uid in self.uids:
+      while j < other_count and other_uids[j] < uid:
+        j += 1
+      if j == other_count:
+        break
+      if other_uids[j] == uid:
+        result.append(uid)
+    return UIDSet.from_sorted(result)
+
+  def batches(self, size):
+    '''Yields UIDSets of at most size UIDs.'''
+    for start in xrange(0, len(self.uids), size):
+      yield UIDSet.from_sorted(self.uids[start:start + size])
+
+  def to_imap(self):
+    '''
+    Returns:
+      string, the UIDs as an IMAP sequence set with consecutive UIDs as ranges
+    '''
+    return ','.join(self._ranges())
+
+  def to_imap_batches(self, max_length=8000):
+    '''Yields the UIDs as IMAP sequence sets of at most max_length characters.
+
+    RFC 7162 recommends command lines of at most 8192 octets, so a set of
+    scattered UIDs is split over several commands.
+    '''
+    batch = []
+    length = 0
+    for uid_range in self._ranges():
+      if batch and length + len(uid_range) > max_length:
+        yield ','.join(batch)
+        batch = []
+        length = 0
+      batch.append(uid_range)
+      length += len(uid_range) + 1
+    if batch:
+      yield ','.join(batch)
+
+  def _ranges(self):
+    ranges = []
+    uids = self.uids
+    count = len(uids)
+    i = 0
+    while i < count:
+      j = i
+      while j + 1 < count and uids[j + 1] == uids[j] + 1:
+        j += 1
+      if j == i:
+        ranges.append(str(uids[i]))
+      else:
+        ranges.append('%d:%d' % (uids[i], uids[j]))
+      i = j + 1
+    return ranges
 
 def GImapHasExtensions(imapconn):
   '''
@@ -99,12 +413,33 @@ def GImapHasExtensions(imapconn):
     boolean, True if Gmail IMAP Extensions defined at:
              http://code.google.com/apis/gmail/imap
              are supported, False if not.
+
+  Note: also updates imapconn.capabilities, servers announce more of them
+        once authenticated.
   '''
   t, d = imapconn.capability()
   if t != 'OK':
     raise GImapHasExtensionsError('GImap Has Extensions could not check server capabilities: %s' % t)
+  imapconn.capabilities = tuple(d[0].upper().split())
   return bool(d[0].count('X-GM-EXT-1'))
 
+def GImapHighestModSeq(imapconn):
+  '''
+  Args:
+    imapconn: object, an IMAP connection that has just selected a folder
+
+  Returns:
+    int, the HIGHESTMODSEQ the server reported for the folder (RFC 4551 CONDSTORE)
+         or None if the server doesn't support CONDSTORE on it.
+
+  Note: servers report HIGHESTMODSEQ in the SELECT response, so call this right
+        after select() and before other commands replace the untagged responses.
+  '''
+  t, d = imapconn.response('HIGHESTMODSEQ')
+  if not d or d[-1] is None:
+    return None
+  return int(d[-1])
+
 def GImapSendID(imapconn, name, version, vendor, contact):
   '''
   Args:
@@ -126,9 +461,15 @@ def GImapSendID(imapconn, name, version, vendor, contact):
     raise GImapSendIDError('GImap Send ID failed to send ID: %s' % t)
   return shlex.split(d[0][1:-1])
 
-def ImapConnect(xoauth_string, debug, compress=False):
+def ImapConnect(xoauth_string, debug, compress=False, host='imap.gmail.com', port=None, plaintext=False):
   #imap_conn = imaplib.IMAP4_SSL('imap.gmail.com')
-  imap_conn = MySSL('imap.gmail.com')
+  if plaintext:
+    imap_conn = MyPlain(host, port or imaplib.IMAP4_PORT)
+  else:
+    imap_conn = MySSL(host, port or imaplib.IMAP4_SSL_PORT)
+  # a small write, like a command line after an upload, must not wait for
+  # the ACK of the previous one (Nagle's algorithm against delayed ACKs)
+  imap_conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
   if debug:
     imap_conn.debug = 4
   imap_conn.authenticate('XOAUTH', lambda x: xoauth_string)
@@ -145,25 +486,308 @@ def ImapConnect(xoauth_string, debug, compress=False):
   GImapSendID(imap_conn, gyb.__program_name__, gyb.__version__, gyb.__author__, gyb.__email__)
   return imap_conn
 
-def GImapSearch(imapconn, gmail_search):
+def GImapSearch(imapconn, gmail_search, uid_range=None):
   '''
   Args:
     imapconn: object, an authenticated IMAP connection to a server supporting the X-GM-EXT1 IMAP capability (imap.gmail.com)
     gmail_search: string, a typical Gmail search as defined at:
                      http://mail.google.com/support/bin/answer.py?answer=7190
+    uid_range: string, optional IMAP UID sequence set like '1000:*' the results are limited to
 
   Returns:
-    list, the IMAP UIDs of messages that match the search
+    UIDSet, the IMAP UIDs of messages that match the search
 
   Note: Only the IMAP Selected folder is searched, it's as if 'in:<current IMAP folder>' is appended to all searches. If you wish to search all mail, select '[Gmail]/All Mail' before performing the search.
   '''
   #t, d = imapconn.search(None, 'X-GM-RAW', gmail_search)
-  gmail_search = gmail_search.replace('\\', '\\\\').replace('"', '\\"')
-  gmail_search = '"' + gmail_search + '"'
-  t, d = imapconn.uid('SEARCH', 'X-GM-RAW', gmail_search)
+  criteria = []
+  if uid_range:
+    criteria += ['UID', uid_range]
+  if gmail_search or not uid_range:
+    gmail_search = gmail_search.replace('\\', '\\\\').replace('"', '\\"')
+    gmail_search = '"' + gmail_search + '"'
+    criteria += ['X-GM-RAW', gmail_search]
+  return GImapUIDSearch(imapconn, *criteria)
+
+def GImapUIDSearch(imapconn, *criteria):
+  '''
+  Args:
+    imapconn: object, an authenticated IMAP connection with a folder selected
+    criteria: strings, IMAP SEARCH keys and arguments like 'X-GM-LABELS', '"\\\\Inbox"'
+
+  Returns:
+    UIDSet, the IMAP UIDs of messages that match the criteria
+  '''
+  t, d = imapconn.uid('SEARCH', *criteria)
   if t != 'OK':
     raise GImapSearchError('GImap Search Failed: %s' % t)
-  return d[0].split()
+  return UIDSet(d[0].split())
+
+fetch_prefix_pattern = re.compile(r'^(?:\* )?[0-9]+ (?:FETCH )?\(')
+# One FETCH item: a name, where BODY[HEADER.FIELDS (FROM TO)] has spaces inside
+# the brackets, and a quoted string, a list without nested lists, a {size}
+# literal marker or an atom as its value
+fetch_item_name = r'[^ \[()]+(?:\[[^\]]*\](?:<[0-9.]+>)?)?'
+fetch_item_quoted = r'"[^"\\]*(?:\\.[^"\\]*)*"'
+fetch_item_value = r'%s|\([^()"]*(?:%s[^()"]*)*\)|\{[0-9]+\}|[^ ()"]+' % (
+  fetch_item_quoted, fetch_item_quoted)
+fetch_item_pattern = re.compile(
+  r' *(?P<name>%s) (?P<value>%s)?' % (fetch_item_name, fetch_item_value))
+fetch_items_pattern = re.compile(r' *(%s) (%s)' % (fetch_item_name, fetch_item_value))
+# Whether all the items can be split by fetch_items_pattern
+fetch_flat_items_pattern = re.compile(
+  r'(?: *(?:%s) (?:%s)(?=[ )]|$))* *(?:\)|$)' % (fetch_item_name, fetch_item_value))
+
+def GImapParseFetchResponse(response):
+  '''
+  Args:
+    response: string, a FETCH response such as '1 (UID 5 X-GM-LABELS ("\\Inbox") FLAGS (\Seen))'
+              with or without the leading message number
+
+  Returns:
+    dict, the unparsed value of every FETCH item by name, like
+          {'UID': '5', 'X-GM-LABELS': '("\\Inbox")', 'FLAGS': '(\Seen)'}.
+          An item sent as a literal has the {size} marker as its value.
+
+  Note: servers return the items in any order they like, so don't rely on it.
+  '''
+  match = fetch_prefix_pattern.match(response)
+  if match:
+    pos = match.end()
+  else:
+    pos = 0
+  if fetch_flat_items_pattern.match(response, pos):
+    return dict((name.upper(), value)
+                for name, value in fetch_items_pattern.findall(response, pos))
+  items = {}
+  while True:
+    match = fetch_item_pattern.match(response, pos)
+    if not match:
+      return items
+    value_start = match.end('name') + 1
+    value_end = match.end()
+    if match.group('value') is None or response[value_end:value_end+1] not in ('', ' ', ')'):
+      # nested lists like BODYSTRUCTURE are left to the slow scan
+      value_end = _fetch_value_end(response, value_start)
+    items[match.group('name').upper()] = response[value_start:value_end]
+    pos = value_end
+
+def _fetch_value_end(response, pos):
+  # a value ends at a space or the closing parenthesis of the response,
+  # outside of quoted strings and parenthesized lists
+  depth = 0
+  quoted = False
+  while pos < len(response):
+    char = response[pos]
+    if quoted:
+      if char == '\\':
+        pos += 1
+      elif char == '"':
+        quoted = False
+    elif char == '"':
+      quoted = True
+    elif char == '(':
+      depth += 1
+    elif char == ')':
+      if depth == 0:
+        return pos
+      depth -= 1
+    elif char == ' ' and depth == 0:
+      return pos
+    pos += 1
+  return pos
+
+fetch_response_pattern = re.compile(r'^\* [0-9]+ FETCH \((?P<items>.*)$')
+literal_pattern = re.compile(r'\{(?P<size>[0-9]+)\}$')
+message_literal_pattern = re.compile(r'(BODY\[[^\]]*\]|RFC822) \{[0-9]+\}$')
+
+def GImapFetchStream(imapconn, uids, fetch_parts, callback, chunk_size=65536):
+  '''
+  Args:
+    imapconn: object, an authenticated IMAP connection with a folder selected
+    uids: string, IMAP UID sequence set of the messages to fetch
+    fetch_parts: string, the IMAP FETCH items to retrieve, BODY[] or BODY.PEEK[] should be last
+    callback: function, called as callback(envelope, literal) for every FETCH response.
+              envelope is the response text before the message literal and literal is
+              an iterator over chunks of the message of at most chunk_size bytes, or
+              None if the response has no message literal. Chunks the callback does
+              not read are skipped.
+    chunk_size: int, the largest chunk of a message literal held in memory
+
+  Returns:
+    tuple, the status and data of the tagged response like imaplib's uid()
+
+  Note: unlike imapconn.uid('FETCH', ...) the responses are never collected in memory,
+        so a batch of large messages can be written to disk one chunk at a time.
+  '''
+  tag = imapconn._new_tag()
+  del imapconn.tagged_commands[tag]
+  command = '%s UID FETCH %s %s' % (tag, uids, fetch_parts)
+  if imapconn.debug >= 4:
+    imapconn._mesg('> %s' % command)
+  imapconn.send('%s\r\n' % command)
+  while True:
+    line = imapconn._get_line()
+    if line.startswith(tag + ' '):
+      typ, _, data = line[len(tag)+1:].partition(' ')
+      return typ, [data]
+    match = fetch_response_pattern.match(line)
+    if not match:
+      if line.startswith('* BYE'):
+        raise imapconn.abort(line[6:])
+      continue
+    envelope = match.group('items')
+    literal = None
+    while literal_pattern.search(envelope):
+      size = int(literal_pattern.search(envelope).group('size'))
+      if message_literal_pattern.search(envelope):
+        literal = _read_literal_chunks(imapconn, size, chunk_size)
+        callback(envelope, literal)
+        for chunk in literal:
+          pass
+      else:
+        # small literals such as a label are inlined as a quoted string
+        data = imapconn.read(size).replace('\\', '\\\\').replace('"', '\\"')
+        envelope = literal_pattern.sub(lambda m: '"%s"' % data, envelope)
+      envelope += imapconn._get_line()
+    if literal is None:
+      callback(envelope, None)
+
+def _read_literal_chunks(imapconn, size, chunk_size):
+  while size > 0:
+    chunk = imapconn.read(min(size, chunk_size))
+    if not chunk:
+      raise imapconn.abort('socket error: EOF')
+    size -= len(chunk)
+    yield chunk
+
+# LITERAL- (RFC 7888) allows non-synchronizing literals up to this size
+NON_SYNC_LITERAL_MAX = 4096
+
+class GImapPipeline(object):
+  '''Sends IMAP commands without waiting for the replies to earlier ones.
+
+  Up to window commands are in flight at a time. The tagged reply of every
+  command is passed to its callback as callback(typ, data), like imaplib
+  returns them. Callbacks run while the pipeline reads replies and may queue
+  more commands, which go out after the command being sent.
+
+  APPEND uploads the message right after the command line when the server
+  supports LITERAL+, or LITERAL- and the message is at most 4096 bytes.
+  Otherwise it waits for the server's continuation request and handles the
+  replies to earlier commands meanwhile. Untagged responses are skipped.
+
+  After imaplib.IMAP4.abort or socket.error the connection is unusable and
+  it is unknown which of the commands in flight the server carried out.
+  '''
+
+  def __init__(self, imapconn, window=8):
+    self.imapconn = imapconn
+    self.window = window
+    self.callbacks = {}
+    self.queued = []
+    self.sending = False
+    self.continuation = False
+    self.literal_plus = 'LITERAL+' in imapconn.capabilities
+    self.literal_minus = 'LITERAL-' in imapconn.capabilities
+
+  def __len__(self):
+    '''Returns the number of commands queued or waiting for their reply.'''
+    return len(self.callbacks) + len(self.queued)
+
+  def command(self, callback, name, *args):
+    '''
+    Args:
+      callback: function, called as callback(typ, data) with the tagged reply
+      name: string, the IMAP command
+      args: the command arguments, quoted where needed like imaplib does
+    '''
+    self._queue(callback, name, args, None)
+
+  def uid(self, callback, command, *args):
+    self.command(callback, 'UID', command, *args)
+
+  def append(self, callback, mailbox, flags, date_time, message):
+    '''
+    Args:
+      callback: function, called as callback(typ, data) with the tagged reply
+      mailbox, flags, date_time, message: like imaplib's append()
+    '''
+    if flags and (flags[0], flags[-1]) != ('(', ')'):
+      flags = '(%s)' % flags
+    if date_time:
+      date_time = imaplib.Time2Internaldate(date_time)
+    self._queue(callback, 'APPEND', (mailbox, flags or None, date_time or None),
+                imaplib.MapCRLF.sub(imaplib.CRLF, message))
+
+  def flush(self):
+    '''Sends the queued commands and waits for all replies.'''
+    self._send_queued()
+    while self.callbacks:
+      self._read_response()
+      self._send_queued()
+
+  def _queue(self, callback, name, args, literal):
+    self.queued.append((callback, name, args, literal))
+    if not self.sending:
+      self._send_queued()
+
+  def _send_queued(self):
+    self.sending = True
+    try:
+      while self.queued:
+        while len(self.callbacks) >= self.window:
+          self._read_response()
+        self._send(*self.queued.pop(0))
+    finally:
+      self.sending = False
+
+  def _send(self, callback, name, args, literal):
+    imapconn = self.imapconn
+    tag = imapconn._new_tag()
+    del imapconn.tagged_commands[tag]
+    command = ' '.join([tag, name] + [str(imapconn._checkquote(arg)) for arg in args if arg is not None])
+    if imapconn.debug >= 4:
+      imapconn._mesg('> %s' % command)
+    self.callbacks[tag] = callback
+    if literal is None:
+      imapconn.send('%s\r\n' % command)
+    elif self.literal_plus or (self.literal_minus and len(literal) <= NON_SYNC_LITERAL_MAX):
+      imapconn.send('%s {%d+}\r\n%s\r\n' % (command, len(literal), literal))
+    else:
+      imapconn.send('%s {%d}\r\n' % (command, len(literal)))
+      self.continuation = False
+      while not self.continuation:
+        if tag not in self.callbacks:
+          # the server refused the command before the literal
+          return
+        self._read_response()
+      imapconn.send(literal + '\r\n')
+
+  def _read_response(self):
+    imapconn = self.imapconn
+    line = imapconn._get_line()
+    if line.startswith('+'):
+      self.continuation = True
+      return
+    if line.startswith('* '):
+      if line.startswith('* BYE'):
+        raise imapconn.abort(line[6:])
+      # like the labels of the FETCH response a STORE causes
+      while literal_pattern.search(line):
+        imapconn.read(int(literal_pattern.search(line).group('size')))
+        line = imapconn._get_line()
+      return
+    tag, _, reply = line.partition(' ')
+    callback = self.callbacks.pop(tag, None)
+    if callback is None:
+      raise imapconn.abort('unexpected tagged response: %s' % line)
+    typ, _, data = reply.partition(' ')
+    sending, self.sending = self.sending, True
+    try:
+      callback(typ, [data])
+    finally:
+      self.sending = sending
 
 def GImapGetMessageLabels(imapconn, uid):
   '''
@@ -202,22 +826,80 @@ def GImapSetMessageLabels(imapconn, uid, labels):
     print 'GImap Set Message Labels Failed: %s' % t
     exit(33)
 
-def GImapGetFolder(imapconn, foldertype='\AllMail'):
+def GImapListFolders(imapconn):
   '''
   Args:
     imapconn: object, an authenticated IMAP connection
-    foldertype: one of the Gmail special folder types
-  
+
   Returns:
-    string,  selectable IMAP name of folder
+    list, (flags, delimiter, name) tuples of every folder XLIST reports,
+          name as sent by the server (possibly quoted)
   '''
   list_response_pattern = re.compile(r'\((?P<flags>.*?)\) "(?P<delimiter>.*)" (?P<name>.*)')
+  commands = {'XLIST' : ('AUTH', 'SELECTED')}
+  imaplib.Commands.update(commands)
   t, d = imapconn.xatom('xlist', '""', '*')
   if t != 'OK':
     raise GImapHasExtensionsError('GImap Get Folder could not check server XLIST: %s' % t)
   xlist_data = imapconn.response('XLIST') [1]
-  for line in xlist_data:
-    flags, delimiter, mailbox_name = list_response_pattern.match(line).groups()
+  return [list_response_pattern.match(line).groups() for line in xlist_data]
+
+def GImapGetFolder(imapconn, foldertype='\AllMail'):
+  '''
+  Args:
+    imapconn: object, an authenticated IMAP connection
+    foldertype: one of the Gmail special folder types
+  
+  Returns:
+    string,  selectable IMAP name of folder
+  '''
+  for flags, delimiter, mailbox_name in GImapListFolders(imapconn):
     if flags.count(foldertype) > 0:
       return mailbox_name
   return None
+
+# X-GM-LABELS names of the system folders, by their XLIST flag
+system_folder_labels = {'\\Inbox': '"\\\\Inbox"',
+                        '\\Starred': '"\\\\Starred"',
+                        '\\Important': '"\\\\Important"',
+                        '\\Sent': '"\\\\Sent"',
+                        '\\Drafts': '"\\\\Draft"'}
+# folders that aren't labels of messages in All Mail
+no_label_folder_flags = ('\\AllMail', '\\Spam', '\\Trash', '\\Noselect')
+
+def GImapGetLabels(imapconn):
+  '''
+  Args:
+    imapconn: object, an authenticated IMAP connection
+
+  Returns:
+    list, the labels of the account written like X-GM-LABELS returns them,
+          e.g. "\\Inbox", Work or "My Label"
+  '''
+  labels = []
+  for flags, delimiter, mailbox_name in GImapListFolders(imapconn):
+    flags = flags.split()
+    system_labels = [system_folder_labels[flag] for flag in flags if flag in system_folder_labels]
+    if system_labels:
+      labels.extend(system_labels)
+    elif not [flag for flag in flags if flag in no_label_folder_flags]:
+      labels.append(GImapLabelToken(GImapUnquote(mailbox_name)))
+  return labels
+
+def GImapUnquote(token):
+  '''
+  Returns:
+    string, the value of an IMAP atom or quoted string token
+  '''
+  if len(token) > 1 and token[0] == '"' and token[-1] == '"':
+    return re.sub(r'\\(.)', r'\1', token[1:-1])
+  return token
+
+def GImapLabelToken(name):
+  '''
+  Returns:
+    string, name as an IMAP atom if it can be one, otherwise a quoted string
+  '''
+  if re.match(r'^[^\x00-\x20\x7f()"{%*\\\]]+$', name):
+    return name
+  return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
@@ -25,11 +25,11 @@ __author__ = 'Jay Lee'
 __email__ = 'jay@jhltechservices.com'
 __version__ = '0.17 Alpha'
 __license__ = 'Apache License 2.0 (http://www.apache.org/licenses/LICENSE-2.0)'
-__db_schema_version__ = '5'
+__db_schema_version__ = '8'
 __db_schema_min_version__ = '2'        #Minimum for restore
 
 import imaplib
-from optparse import OptionParser, SUPPRESS_HELP
+from optparse import OptionParser, OptionValueError, SUPPRESS_HELP
 import webbrowser
 import sys
 import os
@@ -45,8 +45,9 @@ import email.parser
 import re
 import shlex
 import urlparse
-from itertools import islice, chain
 import math
+import threading
+import Queue
 
 import atom.http_core
 import gdata
@@ -56,6 +57,8 @@ import gdata.auth
 import gdata.apps.service
 
 import gimaplib
+import perfstats
+import msgstore
 
 def SetupOptionParser():
   def get_action_labels(option, opt, value, parser):
@@ -76,6 +79,13 @@ def SetupOptionParser():
     # opt is like '--backup'
     parser.values.action = opt[2:]
 
+  def get_byte_size(option, opt, value, parser):
+    match = re.match(r'^([0-9]+)([KMG]?)B?$', value.upper())
+    if not match:
+      raise OptionValueError('option %s: invalid size: %r (use e.g. 512K, 32M or 1G)' % (opt, value))
+    number, unit = match.groups()
+    setattr(parser.values, option.dest, int(number) * {'': 1, 'K': 1024, 'M': 1048576, 'G': 1073741824}[unit])
+
   # Usage message is the module's docstring.
   parser = OptionParser(usage=__doc__)
   parser.add_option('-e', '--email',
@@ -83,10 +93,10 @@ def SetupOptionParser():
     help='Full email address of user to backup')
   parser.add_option('-a', '--action',
     type='choice',
-    choices=['backup','restore','estimate', 'reindex'],
+    choices=['backup','restore','estimate', 'reindex', 'prune', 'compact'],
     dest='action',
     default='backup',
-    help='Optional: Action to perform. backup, restore or estimate.')
+    help='Optional: Action to perform. backup, restore, estimate, prune (remove unreferenced files of the hashed layout) or compact (convert existing message files to --store-compression, gzip if not given).')
   parser.add_option('--action-labels', help=SUPPRESS_HELP)
   parser.add_option('--backup', 
     action='callback', 
@@ -141,16 +151,122 @@ def SetupOptionParser():
     action='store_const',
     const=0,
     help='Optional: disable network compression')
+  parser.add_option('--imap-host',
+    dest='imap_host',
+    default='imap.gmail.com',
+    help='Optional: IMAP server to connect to instead of imap.gmail.com, for example a local test server.')
+  parser.add_option('--imap-port',
+    dest='imap_port',
+    type='int',
+    help='Optional: port of the IMAP server, 993 by default or 143 with --imap-plaintext.')
+  parser.add_option('--imap-plaintext',
+    dest='imap_plaintext',
+    action='store_true',
+    default=False,
+    help='Optional: connect to the IMAP server without SSL. Only use this with a local test server.')
+  parser.add_option('--stats-file',
+    dest='stats_file',
+    help='Optional: append per batch and per run timings of the network, parsing, disk and SQLite stages, throughput and latency percentiles as JSON lines to this file.')
+  parser.add_option('--adaptive-compress',
+    dest='adaptive_compress',
+    action='store_true',
+    default=False,
+    help='Optional: measure how much network compression saves while backing up and reconnect without it when decompressing costs more time than the network saves. Use -C -C to see the decision.')
   parser.add_option('-F', '--fast-incremental',
     dest='refresh',
     action='store_false',
     default=True,
     help='Optional: skips refreshing labels for existing message')
+  parser.add_option('--refresh-strategy',
+    dest='refresh_strategy',
+    type='choice',
+    choices=['auto', 'fetch', 'labels'],
+    default='auto',
+    help='Optional: How labels and flags of messages already backed up are refreshed. fetch gets them for every message, labels runs one search per label and flag. auto (default) uses only messages changed since the last backup when Gmail supports it, and otherwise picks labels when there are many messages per label.')
+  parser.add_option('-N', '--new-only',
+    dest='new_only',
+    action='store_true',
+    default=False,
+    help='Optional: Only search for messages newer than the last full backup instead of listing the whole mailbox. Messages already backed up are still refreshed unless -F is given, but deleted backup files are not noticed.')
+  parser.add_option('--store-layout',
+    dest='store_layout',
+    type='choice',
+    choices=['dated', 'hashed', 'pack'],
+    help='Optional: How new messages are stored. dated (default) uses <year>/<month>/<day>/ folders, hashed names files by a hash of their content so identical messages are stored only once, pack appends messages to large segment files under packs/. With the compact action, moves existing messages to the hashed or pack layout.')
+  parser.add_option('--store-compression',
+    dest='store_compression',
+    type='choice',
+    choices=['none', 'gzip'],
+    help='Optional: Compress message files as they are written. none (default) or gzip.')
+  parser.add_option('--threads',
+    dest='threads',
+    type='int',
+    default=4,
+    help='Optional: Number of threads the compact action converts message files with. Default is 4.')
+  parser.add_option('--trust-db',
+    dest='trust_db',
+    action='store_true',
+    default=False,
+    help='Optional: Assume every message in the backup database still has its file in the backup folder instead of checking the disk.')
   parser.add_option('-B', '--batch-size',
     dest='batch_size',
     type='int',
     default=100,
     help='Optional: Sets the number of messages to include batch when backing up.')
+  parser.add_option('--batch-bytes',
+    dest='batch_bytes',
+    type='string',
+    action='callback',
+    callback=get_byte_size,
+    default=0,
+    help='Optional: Pack backup batches by message size instead of count, up to this many bytes per batch (e.g. 32M). Larger messages are fetched alone.')
+  parser.add_option('--db-journal-mode',
+    dest='db_journal_mode',
+    type='choice',
+    choices=['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'],
+    help='Optional: SQLite journal mode for the backup database, e.g. WAL. Default is SQLite\'s (DELETE).')
+  parser.add_option('--db-synchronous',
+    dest='db_synchronous',
+    type='choice',
+    choices=['OFF', 'NORMAL', 'FULL', 'EXTRA'],
+    help='Optional: SQLite synchronous setting for the backup database, e.g. NORMAL. Default is SQLite\'s (FULL).')
+  parser.add_option('--db-cache-size',
+    dest='db_cache_size',
+    type='string',
+    action='callback',
+    callback=get_byte_size,
+    default=0,
+    help='Optional: SQLite page cache size for the backup database, e.g. 64M.')
+  parser.add_option('--fetch-ahead',
+    dest='fetch_ahead',
+    type='int',
+    default=0,
+    help='Optional: Fetch up to this many batches in the background while the previous batch is saved. Default is 0 (no pipelining).')
+  parser.add_option('--stream',
+    dest='stream',
+    action='store_true',
+    default=False,
+    help='Optional: Write messages to disk while they are downloaded instead of holding a whole batch in memory.')
+  parser.add_option('--connections',
+    dest='connections',
+    type='int',
+    default=1,
+    help='Optional: Number of IMAP connections to download messages over in parallel when backing up, or to upload them over when restoring. Default is 1.')
+  parser.add_option('--pipeline-depth',
+    dest='pipeline_depth',
+    type='int',
+    default=8,
+    help='Optional: Number of APPEND and STORE commands restore keeps in flight on each connection without waiting for their replies. Default is 8, 1 waits for every reply.')
+  parser.add_option('--checkpoint-messages',
+    dest='checkpoint_messages',
+    type='int',
+    default=100,
+    help='Optional: Commit restore progress at least every this many messages. After a crash --resume searches Gmail for up to this many messages to find those restored since the last checkpoint. Default is 100.')
+  parser.add_option('--checkpoint-seconds',
+    dest='checkpoint_seconds',
+    type='int',
+    default=10,
+    help='Optional: Commit restore progress at least every this many seconds. Default is 10.')
   return parser
 
 def getProgPath():
@@ -160,12 +276,6 @@ def getProgPath():
     divider = '\\'
   return os.path.dirname(os.path.realpath(sys.argv[0]))+divider
 
-def batch(iterable, size):
-  sourceiter = iter(iterable)
-  while True:
-    batchiter = islice(sourceiter, size)
-    yield chain([batchiter.next()], batchiter)
-
 def getOAuthFromConfigFile(email):
   cfgFile = '%s%s.cfg' % (getProgPath(), email)
   if os.path.isfile(cfgFile):
@@ -234,7 +344,7 @@ def generateXOAuthString(token, secret, email, two_legged=False):
         nonce=nonce, version='1.0', next=None, token=token, token_secret=secret)
     return '''GET https://mail.google.com/mail/b/%s/imap/ oauth_consumer_key="anonymous",oauth_nonce="%s",oauth_signature="%s",oauth_signature_method="HMAC-SHA1",oauth_timestamp="%s",oauth_token="%s",oauth_version="1.0"''' % (email, nonce, urllib.quote(signature), timestamp, urllib.quote(token))
 
-def getMessagesToBackupList(imapconn, gmail_search='in:anywhere'):
+def getMessagesToBackupList(imapconn, gmail_search='in:anywhere', uid_range=None):
   search_in = gmail_search
   gmail_search = ''
   while search_in:
@@ -257,25 +367,77 @@ def getMessagesToBackupList(imapconn, gmail_search='in:anywhere'):
       break
   if gmail_search:
     print 'using Gmail search: %s' % gmail_search
-  return gimaplib.GImapSearch(imapconn, gmail_search)
+  with perfstats.timer('imap_command'):
+    return gimaplib.GImapSearch(imapconn, gmail_search, uid_range)
 
-def message_is_backed_up(message_num, sqlcur, sqlconn, backup_folder):
-    try:
-      sqlcur.execute('''
-         SELECT message_filename FROM uids NATURAL JOIN messages
-                where uid = ?''', ((message_num),))
-    except sqlite3.OperationalError, e:
-      if e.message == 'no such table: messages':
-        print "\n\nError: your backup database file appears to be corrupted."
-      else:
-        print "SQL error:%s" % e
-      sys.exit(8)
-    sqlresults = sqlcur.fetchall()
-    for x in sqlresults:
-      filename = x[0]
-      if os.path.isfile(os.path.join(backup_folder, filename)):
-        return True
-    return False
+def existing_backup_files(backup_folder, rows):
+  '''
+  Args:
+    backup_folder: string, the backup folder to look in
+    rows: iterable, (uid, message_filename) tuples sorted by file name, so the
+          files of a folder come one after another
+
+  Returns:
+    generator, the rows whose file exists in backup_folder. Each folder is
+    listed when its first file comes up and only its listing is kept.
+  '''
+  folder = None
+  folder_files = set()
+  for uid, filename in rows:
+    rel_folder, name = os.path.split(os.path.normpath(filename))
+    if rel_folder != folder:
+      folder = rel_folder
+      try:
+        folder_files = set(os.listdir(os.path.join(backup_folder, folder)))
+      except OSError:
+        folder_files = set()
+    if name in folder_files:
+      yield uid, filename
+
+def get_backed_up_messages(uids, sqlcur, backup_folder, trust_db=False):
+  '''
+  Args:
+    uids: UIDSet, the IMAP UIDs found on the server
+    sqlcur: object, a cursor of the backup database
+    backup_folder: string, the backup folder
+    trust_db: boolean, if True don't check that message files still exist
+
+  Returns:
+    tuple, UIDSet of UIDs that need to be backed up and UIDSet of UIDs that
+    are already backed up and only need refreshing
+  '''
+  try:
+    sqlcur.executescript('''
+       CREATE TEMP TABLE IF NOT EXISTS server_uids (uid INTEGER PRIMARY KEY);
+       DELETE FROM server_uids;
+    ''')
+    sqlcur.executemany('INSERT OR IGNORE INTO server_uids (uid) VALUES (?)',
+                       ((uid,) for uid in uids))
+    sqlcur.execute('''
+       SELECT uid, message_filename FROM server_uids
+              NATURAL JOIN uids NATURAL JOIN messages ORDER BY message_filename''')
+  except sqlite3.OperationalError, e:
+    if e.message == 'no such table: messages':
+      print "\n\nError: your backup database file appears to be corrupted."
+    else:
+      print "SQL error:%s" % e
+    sys.exit(8)
+  if trust_db:
+    backed_up_uids = gimaplib.UIDSet(uid for uid, filename in sqlcur)
+  else:
+    backed_up_uids = gimaplib.UIDSet(uid for uid, filename in
+                                     existing_backup_files(backup_folder, sqlcur))
+  sqlcur.execute('DELETE FROM server_uids')
+  return uids.difference(backed_up_uids), uids.intersection(backed_up_uids)
+
+def set_db_pragmas(sqlcur, options):
+  if options.db_journal_mode:
+    sqlcur.execute('PRAGMA journal_mode = %s' % options.db_journal_mode)
+  if options.db_synchronous:
+    sqlcur.execute('PRAGMA synchronous = %s' % options.db_synchronous)
+  if options.db_cache_size:
+    # negative values are in KiB rather than pages
+    sqlcur.execute('PRAGMA cache_size = -%d' % (options.db_cache_size // 1024))
 
 def get_db_settings(sqlcur):
   try:
@@ -329,6 +491,24 @@ def convertDB(sqlconn, uidvalidity, oldversion):
           CREATE UNIQUE INDEX labelidx ON labels (message_num, label);
           CREATE UNIQUE INDEX flagidx ON flags (message_num, flag);
         ''')
+      if oldversion < '6':
+        # Convert to schema 6
+        sqlconn.execute('''
+          ALTER TABLE messages ADD COLUMN message_codec TEXT;
+        ''')
+      if oldversion < '7':
+        # Convert to schema 7
+        sqlconn.executescript('''
+          ALTER TABLE messages ADD COLUMN message_offset INTEGER;
+          ALTER TABLE messages ADD COLUMN message_length INTEGER;
+        ''')
+      if oldversion < '8':
+        # Convert to schema 8
+        sqlconn.executescript('''
+          ALTER TABLE messages ADD COLUMN gmail_msgid INTEGER;
+          ALTER TABLE messages ADD COLUMN gmail_thrid INTEGER;
+          CREATE INDEX gmailmsgidx ON messages (gmail_msgid);
+        ''')
       sqlconn.executemany('REPLACE INTO settings (name, value) VALUES (?,?)',
                         (('uidvalidity',uidvalidity), 
                          ('db_version', __db_schema_version__)) )   
@@ -342,69 +522,115 @@ def convertDB(sqlconn, uidvalidity, oldversion):
 def getMessageIDs (sqlconn, backup_folder):   
   sqlcur = sqlconn.cursor()
   header_parser = email.parser.HeaderParser()
-  for message_num, filename in sqlconn.execute('''
-               SELECT message_num, message_filename FROM messages 
+  for message_num, filename, codec, offset, length in sqlconn.execute('''
+               SELECT message_num, message_filename, message_codec,
+                      message_offset, message_length FROM messages 
                       WHERE rfc822_msgid IS NULL'''):
     message_full_filename = os.path.join(backup_folder, filename)
     if os.path.isfile(message_full_filename):
-      f = open(message_full_filename, 'rb')
+      f = msgstore.open_message(backup_folder, filename, codec, offset, length)
       msgid = header_parser.parse(f, True).get('message-id') or '<DummyMsgID>'
       f.close()
       sqlcur.execute(
           'UPDATE messages SET rfc822_msgid = ? WHERE message_num = ?',
                      (msgid, message_num))
+  msgstore.close_segment_maps()
   sqlconn.commit()
  
 def rebuildUIDTable(imapconn, sqlconn):
+  '''
+  Maps the UIDs of the selected All Mail folder to the backed up messages.
+
+  Messages recorded with their X-GM-MSGID are matched with one indexed
+  lookup each. Older ones fall back to matching the Message-ID and
+  INTERNALDATE of their headers, and get their X-GM-MSGID recorded so the
+  next reindex doesn't need the headers.
+  '''
   sqlcur = sqlconn.cursor()
   header_parser = email.parser.HeaderParser()
   sqlcur.execute('DELETE FROM uids')
-  # Create an index on the Message ID to speed up the process
-  sqlcur.execute('CREATE INDEX IF NOT EXISTS msgidx on messages(rfc822_msgid)')
+  sqlcur.executescript('''
+    CREATE TEMP TABLE IF NOT EXISTS server_msgids
+        (uid INTEGER PRIMARY KEY, gmail_msgid INTEGER, gmail_thrid INTEGER);
+    DELETE FROM server_msgids;
+  ''')
   exists = imapconn.response('exists')
   exists = int(exists[1][0])
-  batch_size = 1000
-  for batch_start in xrange(1, exists, batch_size):
-    batch_end = min(exists, batch_start+batch_size-1)
-    t, d = imapconn.fetch('%d:%d' % (batch_start, batch_end),
-                '(UID INTERNALDATE BODY.PEEK[HEADER.FIELDS '
-                             '(FROM TO SUBJECT MESSAGE-ID)])')
+  server_msgids = []
+  def add_server_msgids():
+    sqlcur.executemany('''INSERT OR REPLACE INTO server_msgids
+        (uid, gmail_msgid, gmail_thrid) VALUES (?, ?, ?)''', server_msgids)
+    del server_msgids[:]
+  def save_server_msgid(envelope, literal):
+    fetch_items = gimaplib.GImapParseFetchResponse(envelope)
+    server_msgids.append((fetch_items['UID'],
+                          fetch_items['X-GM-MSGID'],
+                          fetch_items['X-GM-THRID']))
+    if len(server_msgids) >= 10000:
+      add_server_msgids()
+  if exists:
+    with perfstats.timer('imap_command'):
+      t, d = gimaplib.GImapFetchStream(imapconn, '1:*', '(UID X-GM-MSGID X-GM-THRID)',
+                                       save_server_msgid)
+    if t != 'OK':
+      print "\nError: failed to retrieve messages."
+      print "%s %s" % (t, d)
+      sys.exit(5)
+  add_server_msgids()
+  sqlcur.execute('''
+    INSERT OR IGNORE INTO uids (uid, message_num)
+      SELECT uid, message_num FROM server_msgids JOIN messages USING (gmail_msgid)''')
+  if sqlcur.execute('SELECT 1 FROM messages WHERE gmail_msgid IS NULL LIMIT 1').fetchone():
+    unmatched_uids = gimaplib.UIDSet(uid for (uid,) in sqlcur.execute('''
+        SELECT uid FROM server_msgids WHERE uid NOT IN (SELECT uid FROM uids)'''))
+    rebuild_uids_by_header(imapconn, sqlcur, header_parser, unmatched_uids)
+  sqlconn.commit()
+
+def rebuild_uids_by_header(imapconn, sqlcur, header_parser, uids):
+  # Create an index on the Message ID to speed up the process
+  sqlcur.execute('CREATE INDEX IF NOT EXISTS msgidx on messages(rfc822_msgid)')
+  for working_uids in uids.batches(1000):
+    with perfstats.timer('imap_command'):
+      t, d = imapconn.uid('FETCH', working_uids.to_imap(),
+                  '(UID INTERNALDATE BODY.PEEK[HEADER.FIELDS '
+                               '(FROM TO SUBJECT MESSAGE-ID)])')
     if t != 'OK':
       print "\nError: failed to retrieve messages."
       print "%s %s" % (t, d)
       sys.exit(5)
     for extras, header in (x for x in d if x != ')'):
-      uid, message_date = re.search('UID ([0-9]*) (INTERNALDATE \".*\")', 
-                                     extras).groups()
-      time_seconds = time.mktime(imaplib.Internaldate2tuple(message_date))
+      fetch_items = gimaplib.GImapParseFetchResponse(extras)
+      uid = fetch_items['UID']
+      message_date = imaplib.Internaldate2tuple('INTERNALDATE ' + fetch_items['INTERNALDATE'])
+      time_seconds = time.mktime(message_date)
       message_internaldate = datetime.datetime.fromtimestamp(time_seconds)
       m = header_parser.parsestr(header, True)
       msgid = m.get('message-id') or '<DummyMsgID>'
-      message_to = m.get('to')
-      message_from = m.get('from')
-      message_subject = m.get('subject')
-      try:
-        sqlcur.execute('''
-          INSERT INTO uids (uid, message_num) 
-            SELECT ?, message_num FROM messages WHERE
-                   rfc822_msgid = ? AND
-                   message_internaldate = ?
-                   GROUP BY rfc822_msgid 
-                   HAVING count(*) = 1''',
-                   (uid,
-                    msgid,
-                    message_internaldate))
-      except Exception, e:
-       print e
-       print e.message
-       print uid, msgid
-      if sqlcur.lastrowid is None:
+      sqlcur.execute('''
+        INSERT INTO uids (uid, message_num) 
+          SELECT ?, message_num FROM messages WHERE
+                 rfc822_msgid = ? AND
+                 message_internaldate = ? AND
+                 gmail_msgid IS NULL
+                 GROUP BY rfc822_msgid 
+                 HAVING count(*) = 1''',
+                 (uid,
+                  msgid,
+                  message_internaldate))
+      if sqlcur.rowcount < 1:
         print uid, msgid
     print "\b.",
     sys.stdout.flush() 
+  # Remember the X-GM-MSGID of the messages found so they're matched by it next time
+  sqlcur.execute('''
+    UPDATE messages SET
+      gmail_msgid = (SELECT gmail_msgid FROM uids NATURAL JOIN server_msgids
+                      WHERE uids.message_num = messages.message_num),
+      gmail_thrid = (SELECT gmail_thrid FROM uids NATURAL JOIN server_msgids
+                      WHERE uids.message_num = messages.message_num)
+      WHERE gmail_msgid IS NULL''')
   # There is no need to maintain the Index for normal operations
   sqlcur.execute('DROP INDEX msgidx')
-  sqlconn.commit()
 
 def doesTokenMatchEmail(cli_email, key, secret, debug=False):
   s = gdata.apps.service.AppsService(source=__program_name__+' '+__version__)
@@ -434,13 +660,19 @@ def initializeDB(sqlcur, sqlconn, email, uidvalidity):
                          message_from TEXT, 
                          message_subject TEXT, 
                          message_internaldate TIMESTAMP,
-                         rfc822_msgid TEXT);
+                         rfc822_msgid TEXT,
+                         message_codec TEXT,
+                         message_offset INTEGER,
+                         message_length INTEGER,
+                         gmail_msgid INTEGER,
+                         gmail_thrid INTEGER);
    CREATE TABLE labels (message_num INTEGER, label TEXT);
    CREATE TABLE flags (message_num INTEGER, flag TEXT);
    CREATE TABLE uids (message_num INTEGER, uid INTEGER PRIMARY KEY);
    CREATE TABLE settings (name TEXT PRIMARY KEY, value TEXT);
    CREATE UNIQUE INDEX labelidx ON labels (message_num, label);
    CREATE UNIQUE INDEX flagidx ON flags (message_num, flag);
+   CREATE INDEX gmailmsgidx ON messages (gmail_msgid);
   ''')
   sqlcur.executemany('INSERT INTO settings (name, value) VALUES (?, ?)', 
          (('email_address', email),
@@ -448,28 +680,1117 @@ def initializeDB(sqlcur, sqlconn, email, uidvalidity):
           ('uidvalidity', uidvalidity)))
   sqlconn.commit()
 
-def get_message_size(imapconn, uids):
+def get_message_sizes(imapconn, uids):
   if type(uids) == type(int()):
-    uid_string == str(uids)
+    uid_string = str(uids)
   else:
-    uid_string = ','.join(uids)
-  t, d = imapconn.uid('FETCH', uid_string, '(RFC822.SIZE)')
+    uid_string = uids.to_imap()
+  with perfstats.timer('imap_command'):
+    t, d = imapconn.uid('FETCH', uid_string, '(RFC822.SIZE)')
   if t != 'OK':
     print "Failed to retrieve size for message %s" % uid_string
     print "%s %s" % (t, d)
     exit(9)
-  total_size = 0
+  message_sizes = []
   for x in d:
-    message_size = int(re.search('^[0-9]* \(UID [0-9]* RFC822.SIZE ([0-9]*)\)$', x).group(1))
+    fetch_items = gimaplib.GImapParseFetchResponse(x)
+    message_sizes.append((fetch_items['UID'], int(fetch_items['RFC822.SIZE'])))
+  return message_sizes
+
+def get_message_size(imapconn, uids):
+  total_size = 0
+  for uid, message_size in get_message_sizes(imapconn, uids):
     total_size = total_size + message_size
   return total_size
-  
+
+def batch_by_size(imapconn, uids, batch_bytes):
+  '''
+  Args:
+    imapconn: object, an authenticated IMAP connection with ALL_MAIL selected
+    uids: UIDSet, the IMAP UIDs to batch
+    batch_bytes: int, the target total RFC822.SIZE of each batch
+
+  Returns:
+    generator of UIDSets whose sizes add up to at most batch_bytes.
+    A message larger than batch_bytes gets a batch of its own.
+  '''
+  working_messages = []
+  working_bytes = 0
+  for sizing_messages in uids.batches(10000):
+    for uid, message_size in get_message_sizes(imapconn, sizing_messages):
+      if working_messages and working_bytes + message_size > batch_bytes:
+        yield gimaplib.UIDSet(working_messages)
+        working_messages = []
+        working_bytes = 0
+      working_messages.append(uid)
+      working_bytes += message_size
+  if working_messages:
+    yield gimaplib.UIDSet(working_messages)
+
+def connect_imap(key, secret, options, compress):
+  return gimaplib.ImapConnect(generateXOAuthString(key, secret, options.email, options.two_legged), options.debug, compress,
+                              options.imap_host, options.imap_port, options.imap_plaintext) # dynamically generate the xoauth_string since they expire after 10 minutes
+
+def connect_all_mail(key, secret, options, readonly=True, tuner=None):
+  compress = options.compress and (tuner is None or tuner.enabled)
+  with perfstats.timer('reconnect'):
+    imapconn = connect_imap(key, secret, options, compress)
+    imapconn.select(ALL_MAIL, readonly=readonly)
+  return imapconn
+
+def with_retry(imapconn, reconnect, operation):
+  '''
+  Runs operation until it gets through without an imaplib abort or socket
+  error, on a new connection after every failure. Retries at once, then
+  after 2, 4, 8... seconds up to a minute.
+
+  Args:
+    imapconn: object, an IMAP connection, or None to connect with reconnect
+    reconnect: function, returns a new connection like imapconn
+    operation: function, given the connection returns the result
+
+  Returns:
+    tuple, the IMAP connection used last and the result of operation
+  '''
+  failures = 0
+  while True:
+    try:
+      if imapconn is None:
+        imapconn = reconnect()
+      return imapconn, operation(imapconn)
+    except imaplib.IMAP4.abort, e:
+      print '\nimaplib.abort error:%s, retrying...' % e
+    except socket.error, e:
+      print '\nsocket.error:%s, retrying...' % e
+    imapconn = None
+    failures += 1
+    if failures > 1:
+      time.sleep(min(math.pow(2, failures - 1), 64))
+
+def fetch_with_retry(imapconn, reconnect, uids, fetch_parts, callback=None):
+  '''
+  Args:
+    imapconn: object, an authenticated IMAP connection with ALL_MAIL selected
+    reconnect: function, returns a new connection with ALL_MAIL selected
+    uids: UIDSet, the IMAP UIDs to fetch, or a sequence set string like 1:*
+    fetch_parts: string, the IMAP FETCH items to retrieve
+    callback: function, if given the messages are streamed to it with
+              gimaplib.GImapFetchStream() instead of being returned
+
+  Returns:
+    tuple, the (possibly reconnected) IMAP connection and the FETCH data
+  '''
+  if isinstance(uids, gimaplib.UIDSet):
+    batch_string = uids.to_imap()
+  else:
+    batch_string = uids
+  def fetch(imapconn):
+    with perfstats.timer('imap_command'):
+      if callback:
+        return gimaplib.GImapFetchStream(imapconn, batch_string, fetch_parts, callback)
+      return imapconn.uid('FETCH', batch_string, fetch_parts)
+  bad_count = 0
+  while True:
+    imapconn, (r, d) = with_retry(imapconn, reconnect, fetch)
+    if r != 'OK':
+      bad_count = bad_count + 1
+      if bad_count > 7:
+        print "\nError: failed to retrieve messages."
+        print "%s %s" % (r, d)
+        sys.exit(5)
+      sleep_time = math.pow(2, bad_count)
+      sys.stdout.write("\nServer responded with %s %s, will retry in %s seconds" % (r, d, str(sleep_time)))
+      time.sleep(sleep_time) # sleep 2 seconds, then 4, 8, 16, 32, 64, 128
+      imapconn = None
+      continue
+    return imapconn, d
+
+def worker_session(owner, worker_num, work):
+  '''
+  Runs work in the IMAP session of a worker thread of owner. The first worker
+  keeps using owner.imapconn and leaves the connection it ends with there,
+  the others open their own session with owner.reconnect() and log it out
+  when they are done.
+
+  Args:
+    owner: object, a BatchFetcher or MessageRestorer
+    worker_num: int, the number of the worker thread
+    work: function, given an IMAP connection returns the connection it used
+          last
+  '''
+  if worker_num == 0:
+    owner.imapconn = work(owner.imapconn)
+  else:
+    work(owner.reconnect()).logout()
+
+class BatchFetcher(object):
+  '''Fetches batches in background threads so the network stays busy while
+  the previous batch is written to disk and SQLite.
+
+  Each of the connections threads runs its own IMAP session and takes the
+  next batch from the shared batches iterator. Iterating over the fetcher
+  yields (uids, data) tuples as batches complete, which may be out of order
+  when several connections are used. At most fetch_ahead fetched batches
+  wait in the queue, which caps memory use. If the fetcher was never started
+  the batches are fetched inline instead.
+
+  If save_message is given, messages are streamed to it as they arrive and
+  the data yielded for a batch is the list of values it returned.
+
+  If a gimaplib.CompressionTuner is given, every connection is sampled after
+  each batch and reconnected without compression once the tuner disables it.
+  '''
+
+  def __init__(self, imapconn, reconnect, batches, fetch_parts, fetch_ahead, connections=1, save_message=None,
+               tuner=None):
+    self.imapconn = imapconn
+    self.reconnect = reconnect
+    self.batches = batches
+    self.batches_lock = threading.Lock()
+    self.fetch_parts = fetch_parts
+    self.fetched = Queue.Queue(max(fetch_ahead, connections))
+    self.connections = connections
+    self.save_message = save_message
+    self.tuner = tuner
+    self.workers = []
+
+  def fetch(self, imapconn, working_messages):
+    if not self.save_message:
+      return fetch_with_retry(imapconn, self.reconnect, working_messages, self.fetch_parts)
+    # Keyed by UID so messages streamed again after a retry are not doubled
+    saved_messages = {}
+    def callback(envelope, literal):
+      saved_message = self.save_message(envelope, literal)
+      saved_messages[saved_message[0]] = saved_message
+    imapconn, d = fetch_with_retry(imapconn, self.reconnect, working_messages, self.fetch_parts, callback)
+    return imapconn, saved_messages.values()
+
+  def tune(self, imapconn):
+    if self.tuner and self.tuner.sample(imapconn):
+      imapconn.logout()
+      imapconn = self.reconnect()
+    return imapconn
+
+  def start(self):
+    for worker_num in range(self.connections):
+      worker = threading.Thread(target=self.fetch_worker, args=(worker_num,))
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+  def next_batch(self):
+    with self.batches_lock:
+      try:
+        return self.batches.next()
+      except StopIteration:
+        return None
+
+  def fetch_worker(self, worker_num):
+    try:
+      worker_session(self, worker_num, self.fetch_batches)
+    except BaseException:
+      self.fetched.put(sys.exc_info())
+    self.fetched.put(None)
+
+  def fetch_batches(self, imapconn):
+    while True:
+      working_messages = self.next_batch()
+      if working_messages is None:
+        return imapconn
+      imapconn, d = self.fetch(imapconn, working_messages)
+      imapconn = self.tune(imapconn)
+      self.fetched.put((working_messages, d))
+
+  def __iter__(self):
+    if not self.workers:
+      for working_messages in self.batches:
+        self.imapconn, d = self.fetch(self.imapconn, working_messages)
+        self.imapconn = self.tune(self.imapconn)
+        yield working_messages, d
+      return
+    finished_workers = 0
+    while finished_workers < len(self.workers):
+      with perfstats.timer('fetch_wait'):
+        fetched = self.fetched.get()
+      if fetched is None:
+        finished_workers += 1
+        continue
+      if len(fetched) == 3:
+        raise fetched[0], fetched[1], fetched[2]
+      yield fetched
+
+class MessageRestorer(object):
+  '''Restores messages over several IMAP connections at once.
+
+  Each of the connections threads runs its own IMAP session, takes the next
+  message from a shared queue and appends it through a RestoreConnection.
+  The message_nums and new UIDs of restored messages are handed back to a
+  single thread that records them in the resume database, so --resume stays
+  correct whatever order the workers finish in. The labels are added after
+  all messages are appended, see restore_labels().
+
+  first_uid is the UIDNEXT of All Mail before the restore. Only UIDs from it
+  on that no other message was restored to can belong to a message whose
+  session failed before its reply arrived, see claimed_uids().
+  '''
+
+  def __init__(self, imapconn, reconnect, backup_folder, connections=1, pipeline_depth=1,
+               first_uid=None):
+    self.imapconn = imapconn
+    self.reconnect = reconnect
+    self.backup_folder = backup_folder
+    self.messages = Queue.Queue(connections * max(pipeline_depth, 4))
+    self.restored = Queue.Queue()
+    self.connections = connections
+    self.pipeline_depth = pipeline_depth
+    self.workers = []
+    self.finished_workers = 0
+    self.error = None
+    self.first_uid = first_uid
+    # guarded by lock: the UIDs messages were restored to by this restore and
+    # the number of messages in flight by Message-ID
+    self.restored_uids = set()
+    self.in_flight_msgids = {}
+    self.lock = threading.Lock()
+
+  def start(self):
+    for worker_num in range(self.connections):
+      worker = threading.Thread(target=self.restore_worker, args=(worker_num,))
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+  def put(self, message):
+    '''
+    Args:
+      message: tuple, the message_num, internal date in seconds, file name,
+               codec, offset, length, flags string and Message-ID of a message
+    '''
+    while not self.error:
+      try:
+        self.messages.put(message, True, 1)
+        return
+      except Queue.Full:
+        # check again that the workers didn't stop on an error
+        pass
+
+  def finish(self):
+    for worker in self.workers:
+      self.put(None)
+
+  def raise_error(self):
+    '''Raises the error a worker stopped on, once all workers stopped and what
+    they restored is recorded.'''
+    if self.error and self.finished_workers == len(self.workers):
+      raise self.error[0], self.error[1], self.error[2]
+
+  def restored_messages(self, wait=False):
+    '''
+    Returns:
+      list, the (message_num, restored_uid) tuples of the messages restored
+      since the last call. If wait or a worker stopped on an error, waits
+      until all the workers are done.
+    '''
+    restored = []
+    while self.finished_workers < len(self.workers):
+      try:
+        message = self.restored.get(wait or self.error is not None)
+      except Queue.Empty:
+        break
+      if message is None:
+        self.finished_workers += 1
+      else:
+        restored.append(message)
+    return restored
+
+  def claimed_uids(self, uids):
+    '''
+    Args:
+      uids: list, UIDs found for the Message-IDs of messages in flight
+
+    Returns:
+      set, the uids that are older than the restore or were restored to
+      already. All of them if the server didn't tell UIDNEXT.
+    '''
+    if self.first_uid is None:
+      return set(uids)
+    return set(uid for uid in uids if uid < self.first_uid or uid in self.restored_uids)
+
+  def restore_worker(self, worker_num):
+    try:
+      worker_session(self, worker_num, self.restore_messages)
+    except BaseException:
+      self.error = sys.exc_info()
+    self.restored.put(None)
+
+  def restore_messages(self, imapconn):
+    connection = RestoreConnection(self, imapconn)
+    while True:
+      try:
+        message = self.messages.get(False)
+      except Queue.Empty:
+        # collect the replies while there is nothing to send
+        connection.finish()
+        try:
+          message = self.messages.get(True, 1)
+        except Queue.Empty:
+          # no more messages come once another worker stopped on an error
+          if self.error:
+            break
+          continue
+      if message is None or self.error:
+        break
+      connection.restore(message)
+    connection.finish()
+    return connection.imapconn
+
+class RestoreConnection(object):
+  '''One session of a MessageRestorer with its APPENDs pipelined.
+
+  A message stays in flight until its APPENDUID arrives. If the session
+  fails, a new one looks up which of the messages in flight were appended
+  anyway and appends the others again, see with_retry().
+  '''
+
+  def __init__(self, restorer, imapconn):
+    self.restorer = restorer
+    self.imapconn = imapconn
+    self.pipeline = gimaplib.GImapPipeline(imapconn, restorer.pipeline_depth)
+    # message_num: (message tuple, message)
+    self.in_flight = {}
+    # the error and exit code of a command the server refused
+    self.refused = None
+
+  def restore(self, message):
+    message_num, internaldate_seconds, filename, codec, offset, length = message[:6]
+    with perfstats.timer('file_read'):
+      f = msgstore.open_message(self.restorer.backup_folder, filename, codec, offset, length)
+      full_message = f.read()
+      f.close()
+    perfstats.count('message_bytes', len(full_message))
+    self.in_flight[message_num] = (message, full_message)
+    with self.restorer.lock:
+      msgids = self.restorer.in_flight_msgids
+      msgids[message[7]] = msgids.get(message[7], 0) + 1
+    self.retry(self.send, message_num)
+    if self.refused:
+      self.finish()
+
+  def finish(self):
+    '''Waits until everything in flight is restored.
+
+    If the server refused a command, exits once the replies to the commands
+    sent after it are in, so the messages they restored are recorded.
+    '''
+    while self.in_flight:
+      self.retry(lambda: self.pipeline.flush())
+    if self.refused:
+      error, exit_code = self.refused
+      print error
+      sys.exit(exit_code)
+
+  def retry(self, operation, *args):
+    '''Runs operation, or after a failed session resends what is in flight.'''
+    def run(imapconn):
+      if imapconn is not self.imapconn:
+        # the replies to what the failed session sent are lost
+        self.imapconn = imapconn
+        self.pipeline = gimaplib.GImapPipeline(imapconn, self.restorer.pipeline_depth)
+        self.find_in_flight()
+        with perfstats.timer('imap_command'):
+          for message_num in sorted(self.in_flight):
+            if message_num in self.in_flight:
+              self.send(message_num)
+      else:
+        with perfstats.timer('imap_command'):
+          operation(*args)
+    with_retry(self.imapconn, self.restorer.reconnect, run)
+
+  def find_in_flight(self):
+    '''Records the messages in flight the failed session appended already.
+
+    A message whose Message-ID another session has in flight too is appended
+    again, that session's copy may be in Gmail without its UID known yet.
+    The searches run without the restorer lock so the other sessions go on,
+    the UIDs are claimed with it once they are done.
+    '''
+    own_msgids = {}
+    for message, full_message in self.in_flight.values():
+      own_msgids[message[7]] = own_msgids.get(message[7], 0) + 1
+    def only_in_flight_here(message):
+      return self.restorer.in_flight_msgids[message[7]] == own_msgids[message[7]]
+    with self.restorer.lock:
+      messages = [(message_num, message[7])
+                  for message_num, (message, full_message) in self.in_flight.items()
+                  if only_in_flight_here(message)]
+    candidates = search_appended(self.imapconn, messages)
+    with self.restorer.lock:
+      # another session may have sent one of the Message-IDs meanwhile
+      candidates = [(message_num, uids) for message_num, uids in candidates
+                    if only_in_flight_here(self.in_flight[message_num][0])]
+      found = claim_appended(candidates, self.restorer.claimed_uids)
+      # claimed before the lock is let go, so no other session claims them
+      self.restorer.restored_uids.update(restored_uid for message_num, restored_uid in found)
+    for message_num, restored_uid in found:
+      self.landed(message_num, restored_uid)
+
+  def landed(self, message_num, restored_uid=None):
+    '''Takes a message out of flight, restored to restored_uid if given.'''
+    message, full_message = self.in_flight.pop(message_num)
+    with self.restorer.lock:
+      msgids = self.restorer.in_flight_msgids
+      msgids[message[7]] -= 1
+      if not msgids[message[7]]:
+        del msgids[message[7]]
+      if restored_uid is not None:
+        self.restorer.restored_uids.add(restored_uid)
+    if restored_uid is not None:
+      self.restorer.restored.put((message_num, restored_uid))
+
+  def send(self, message_num):
+    message, full_message = self.in_flight[message_num]
+    internaldate_seconds, flags_string = message[1], message[6]
+    self.pipeline.append(lambda r, d: self.appended(message_num, r, d),
+                         ALL_MAIL, flags_string, internaldate_seconds, full_message)
+
+  def appended(self, message_num, r, d):
+    if r != 'OK':
+      self.landed(message_num)
+      if not self.refused:
+        self.refused = ('\nError: %s %s' % (r,d), 5)
+      return
+    restored_uid = int(re.search('^[APPENDUID [0-9]* ([0-9]*)] \(Success\)$', d[0]).group(1))
+    self.landed(message_num, restored_uid)
+
+def record_restored(sqlconn, restored, restored_count, restore_count):
+  '''
+  Args:
+    sqlconn: object, the connection with the resume database attached
+    restored: list, the (message_num, restored_uid) tuples of the messages
+              MessageRestorer restored
+    restored_count: int, the messages recorded before
+    restore_count: int, the messages to restore
+
+  Returns:
+    int, the number of messages recorded
+  '''
+  if not restored:
+    return 0
+  #Save the fact that they are completed, their labels are added later.
+  #They are committed by the next checkpoint_restored().
+  with perfstats.timer('sqlite'):
+    sqlconn.executemany(
+      'INSERT OR REPLACE INTO restored_messages (message_num, restored_uid, labeled) VALUES (?, ?, 0)',
+         restored)
+  restart_line()
+  sys.stdout.write("restored %s of %s messages" % (restored_count + len(restored), restore_count))
+  sys.stdout.flush()
+  return len(restored)
+
+def checkpoint_restored(sqlconn, dispatched_message_num=None):
+  '''
+  Commits the restored messages recorded since the last checkpoint.
+
+  Args:
+    sqlconn: object, the connection with the resume database attached
+    dispatched_message_num: int, optional highest message_num restore may
+                            hand out before the next checkpoint. Messages up
+                            to it that are not recorded may still be in Gmail
+                            after a crash, see find_restored().
+  '''
+  if dispatched_message_num is not None:
+    with perfstats.timer('sqlite'):
+      sqlconn.execute('''REPLACE INTO resume.restore_settings (name, value)
+                         VALUES ('dispatched_message_num', ?)''', (dispatched_message_num,))
+  with perfstats.timer('commit'):
+    sqlconn.commit()
+
+def find_appended(imapconn, messages, claimed_uids):
+  '''
+  Looks up messages an APPEND may have added to Gmail without its reply
+  getting back. Each message is searched by its Message-ID and takes the
+  lowest UID found for it that no other message claimed. If there are more
+  messages with a Message-ID than unclaimed UIDs, the extra ones are not
+  found and get restored again.
+
+  Args:
+    imapconn: object, an IMAP connection with All Mail selected
+    messages: list, the (message_num, Message-ID) tuples to look up
+    claimed_uids: function, given a list of UIDs returns the set of those
+                  that belong to another message already
+
+  Returns:
+    list, the (message_num, restored_uid) tuples of the messages found
+  '''
+  return claim_appended(search_appended(imapconn, messages), claimed_uids)
+
+def search_appended(imapconn, messages):
+  '''
+  Returns:
+    list, the (message_num, UIDSet) tuples of the messages whose Message-ID
+    Gmail has, see find_appended()
+  '''
+  candidates = []
+  for message_num, msgid in messages:
+    if not msgid or msgid == '<DummyMsgID>':
+      continue
+    with perfstats.timer('imap_command'):
+      uids = gimaplib.GImapSearch(imapconn, 'rfc822msgid:%s' % msgid)
+    if len(uids) > 0:
+      candidates.append((message_num, uids))
+  return candidates
+
+def claim_appended(candidates, claimed_uids):
+  '''
+  Returns:
+    list, the (message_num, restored_uid) tuples of the candidates of
+    search_appended() that got an unclaimed UID, see find_appended()
+  '''
+  claimed = claimed_uids([uid for candidate_num, candidate_uids in candidates
+                          for uid in candidate_uids])
+  found = []
+  # messages are appended in message_num order, so earlier ones got lower UIDs
+  for message_num, uids in sorted(candidates):
+    unclaimed = [uid for uid in uids if uid not in claimed]
+    if unclaimed:
+      claimed.add(min(unclaimed))
+      found.append((message_num, min(unclaimed)))
+  return found
+
+def find_restored(imapconn, sqlconn, readcur, restore_where, msgid_column):
+  '''
+  Finds the messages an interrupted restore appended after its last
+  checkpoint, so --resume doesn't append them twice. Each message up to the
+  dispatched_message_num of the last checkpoint that is not recorded as
+  restored is looked up by its Message-ID, see find_appended(). Messages
+  without one are restored again.
+
+  Args:
+    imapconn: object, an IMAP connection with All Mail selected
+    sqlconn: object, the connection with the resume database attached
+    readcur: object, a cursor of the connection with the skip_messages table
+    restore_where: string, the SQL condition of the messages to restore
+    msgid_column: string, the SQL expression of the Message-ID of a message
+
+  Returns:
+    int, the number of messages found and recorded as restored
+  '''
+  dispatched = sqlconn.execute('''SELECT value FROM resume.restore_settings
+                                    WHERE name = 'dispatched_message_num' ''').fetchone()
+  if dispatched is None:
+    return 0
+  first_uid = sqlconn.execute('''SELECT value FROM resume.restore_settings
+                                   WHERE name = 'first_uid' ''').fetchone()
+  readcur.execute('SELECT message_num, %s FROM messages WHERE message_num <= ? AND %s' % (
+                    msgid_column, restore_where), (int(dispatched[0]),))
+  unrecorded = readcur.fetchall()
+  def claimed_uids(uids):
+    # UIDs below the UIDNEXT of the first run were in Gmail before the
+    # restore. The UIDs are ints from the server, there may be more than
+    # SQLite takes as parameters.
+    claimed = set(uid for uid, in sqlconn.execute(
+      'SELECT restored_uid FROM restored_messages WHERE restored_uid IN (%s)' % (
+        ','.join(str(uid) for uid in uids))))
+    if first_uid is not None:
+      claimed.update(uid for uid in uids if uid < int(first_uid[0]))
+    return claimed
+  found = find_appended(imapconn, unrecorded, claimed_uids)
+  if found:
+    sqlconn.executemany(
+      'INSERT OR REPLACE INTO restored_messages (message_num, restored_uid, labeled) VALUES (?, ?, 0)',
+         found)
+    checkpoint_restored(sqlconn)
+    readcur.executemany('INSERT OR IGNORE INTO skip_messages (message_num) VALUES (?)',
+                        ((message_num,) for message_num, restored_uid in found))
+  print "%s of %s messages restored since the last checkpoint were already in Gmail" % (
+          len(found), len(unrecorded))
+  return len(found)
+
+def restore_labels(imapconn, reconnect, sqlconn, label_restored=None, pipeline_depth=1):
+  '''
+  Adds the labels of the restored messages that don't have them yet with one
+  UID STORE per label and set of UIDs instead of one STORE per message.
+
+  Args:
+    imapconn: object, an IMAP connection with All Mail selected read/write,
+              or None to connect with reconnect
+    reconnect: function, returns a new connection like imapconn
+    sqlconn: object, the connection with the resume database attached
+    label_restored: string, optional label added to every restored message
+    pipeline_depth: int, the STORE commands sent without waiting for replies
+
+  Returns:
+    object, the IMAP connection used last
+  '''
+  uids_by_label = {}
+  with perfstats.timer('sqlite'):
+    for label, restored_uid in sqlconn.execute('''
+        SELECT label, restored_uid FROM labels NATURAL JOIN restored_messages
+          WHERE restored_uid IS NOT NULL AND NOT labeled'''):
+      # the labels are stored as Gmail sent them, quoted or not
+      uids_by_label.setdefault(gimaplib.GImapUnquote(label), []).append(restored_uid)
+    if label_restored:
+      uids_by_label.setdefault(label_restored, []).extend(restored_uid for (restored_uid,) in sqlconn.execute(
+        'SELECT restored_uid FROM restored_messages WHERE restored_uid IS NOT NULL AND NOT labeled'))
+  stores = []
+  for label in sorted(uids_by_label):
+    labels_string = '(%s)' % gimaplib.GImapLabelToken(label)
+    for uid_set in gimaplib.UIDSet(uids_by_label[label]).to_imap_batches():
+      stores.append((uid_set, labels_string))
+  pending = set(range(len(stores)))
+  def stored(store_num):
+    def callback(r, d):
+      if r != 'OK':
+        print '\nGImap Set Message Labels Failed: %s %s' % (r, d)
+        sys.exit(33)
+      pending.discard(store_num)
+      restart_line()
+      sys.stdout.write("labeled %s of %s sets of messages" % (len(stores) - len(pending), len(stores)))
+      sys.stdout.flush()
+    return callback
+  def store(imapconn):
+    # after a failed session, what is still pending is sent again
+    pipeline = gimaplib.GImapPipeline(imapconn, pipeline_depth)
+    with perfstats.timer('imap_command'):
+      for store_num in sorted(pending):
+        uid_set, labels_string = stores[store_num]
+        pipeline.uid(stored(store_num), 'STORE', uid_set, '+X-GM-LABELS', labels_string)
+      pipeline.flush()
+  if pending:
+    imapconn = with_retry(imapconn, reconnect, store)[0]
+  perfstats.batch(0)
+  with perfstats.timer('sqlite'):
+    sqlconn.execute('UPDATE restored_messages SET labeled = 1 WHERE restored_uid IS NOT NULL')
+  with perfstats.timer('commit'):
+    sqlconn.commit()
+  if stores:
+    print
+  return imapconn
+
+def get_codec(store_compression):
+  '''
+  Returns:
+    string, the message codec for a --store-compression value, None for none
+  '''
+  if store_compression in (None, 'none'):
+    return None
+  return store_compression
+
+def save_message(everything_else_string, message_chunks, backup_folder, uidvalidity, header_parser,
+                 store_layout='dated', spool_size=None, codec=None):
+  '''
+  Args:
+    everything_else_string: string, the FETCH response items before the message
+    message_chunks: iterable of strings that make up the full message
+    backup_folder: string, the backup folder to save the message in
+    uidvalidity: string, the UIDVALIDITY of the All Mail folder
+    header_parser: object, an email.parser.HeaderParser
+    store_layout: string, 'dated', 'hashed' or 'pack', see msgstore.MessageWriter
+    spool_size: int, bytes of a message kept in memory before spooling to disk
+    codec: string, 'gzip' to compress the message file or None
+
+  Returns:
+    tuple, the uid, labels, flags, internal date, file name, to, from,
+    subject, Message-ID, codec, offset, length, X-GM-MSGID and X-GM-THRID
+    of the saved message for record_message_batch()
+  '''
+  with perfstats.timer('parse_response'):
+    fetch_items = gimaplib.GImapParseFetchResponse(everything_else_string)
+    labels = shlex.split(fetch_items['X-GM-LABELS'][1:-1], posix=False)
+    uid = fetch_items['UID']
+    message_date_string = 'INTERNALDATE ' + fetch_items['INTERNALDATE']
+    message_flags_string = 'FLAGS ' + fetch_items['FLAGS']
+    message_date = imaplib.Internaldate2tuple(message_date_string)
+    time_seconds_since_epoch = time.mktime(message_date)
+    message_internal_datetime = datetime.datetime.fromtimestamp(time_seconds_since_epoch)
+    message_flags = imaplib.ParseFlags(message_flags_string)
+  message_bytes = 0
+  with perfstats.timer('file_write'):
+    message_writer = msgstore.MessageWriter(backup_folder,
+                                            msgstore.dated_filename(uidvalidity, uid, message_date),
+                                            store_layout, spool_size, codec)
+    for chunk in message_chunks:
+      message_writer.write(chunk)
+      message_bytes += len(chunk)
+    message_rel_filename = message_writer.close()
+  perfstats.count('message_bytes', message_bytes)
+  with perfstats.timer('parse_headers'):
+    m = header_parser.parsestr(message_writer.headers, True)
+  return (uid,
+          labels,
+          message_flags,
+          message_internal_datetime,
+          message_rel_filename,
+          m.get('to'),
+          m.get('from'),
+          m.get('subject'),
+          m.get('message-id'),
+          message_writer.codec,
+          message_writer.offset,
+          message_writer.length,
+          fetch_items.get('X-GM-MSGID'),
+          fetch_items.get('X-GM-THRID'))
+
+def record_message_batch(sqlcur, saved_messages):
+  '''
+  Args:
+    sqlcur: object, a cursor of the backup database
+    saved_messages: list, tuples returned by save_message()
+
+  The batch is written with one executemany() per table. The writer is the
+  only one adding messages, so message_nums are allocated as a block after
+  the current highest one instead of reading lastrowid for every message.
+  '''
+  with perfstats.timer('sqlite'):
+    record_messages(sqlcur, saved_messages)
+
+def record_messages(sqlcur, saved_messages):
+  sqlcur.execute('SELECT max(message_num) FROM messages')
+  last_message_num = sqlcur.fetchone()[0] or 0
+  message_rows = []
+  uid_rows = []
+  label_rows = []
+  flag_rows = []
+  for message_num, saved_message in enumerate(saved_messages, last_message_num + 1):
+    (uid, labels, message_flags, message_internal_datetime, message_rel_filename,
+     message_to, message_from, message_subj, message_id, codec,
+     message_offset, message_length, gmail_msgid, gmail_thrid) = saved_message
+    message_rows.append((message_num,
+                         message_rel_filename,
+                         message_to,
+                         message_from,
+                         message_subj,
+                         message_internal_datetime,
+                         message_id,
+                         codec,
+                         message_offset,
+                         message_length,
+                         gmail_msgid,
+                         gmail_thrid))
+    uid_rows.append((message_num, uid))
+    label_rows.extend((message_num, label) for label in labels)
+    flag_rows.extend((message_num, flag) for flag in message_flags)
+  sqlcur.executemany("""
+       INSERT INTO messages (
+                   message_num,
+                   message_filename,
+                   message_to,
+                   message_from,
+                   message_subject,
+                   message_internaldate,
+                   rfc822_msgid,
+                   message_codec,
+                   message_offset,
+                   message_length,
+                   gmail_msgid,
+                   gmail_thrid) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", message_rows)
+  sqlcur.executemany("""
+       REPLACE INTO uids (message_num, uid) VALUES (?, ?)""", uid_rows)
+  sqlcur.executemany("""
+       INSERT INTO labels (message_num, label) VALUES (?, ?)""", label_rows)
+  sqlcur.executemany("""
+       INSERT INTO flags (message_num, flag) VALUES (?, ?)""", flag_rows)
+
+def refresh_message_batch(d, sqlcur):
+  '''
+  Args:
+    d: list, FETCH (X-GM-LABELS X-GM-MSGID X-GM-THRID FLAGS) responses of a batch of messages
+    sqlcur: object, a cursor of the backup database
+
+  Returns:
+    int, the number of messages refreshed
+
+  The current labels and flags of the whole batch are loaded into temp
+  tables keyed by message_num and reconciled with a few set statements, so the SQL
+  work doesn't grow with the number of messages in the batch. Messages
+  backed up before X-GM-MSGID was recorded get it filled in.
+  '''
+  refresh_uids = []
+  refresh_labels = []
+  refresh_flags = []
+  with perfstats.timer('parse_response'):
+    for results in d:
+      fetch_items = gimaplib.GImapParseFetchResponse(results)
+      labels = shlex.split(fetch_items['X-GM-LABELS'][1:-1], posix=False)
+      uid = fetch_items['UID']
+      message_flags = imaplib.ParseFlags('FLAGS ' + fetch_items['FLAGS'])
+      refresh_uids.append((uid, fetch_items.get('X-GM-MSGID'), fetch_items.get('X-GM-THRID')))
+      refresh_labels.extend((uid, label) for label in labels)
+      refresh_flags.extend((uid, flag) for flag in message_flags)
+  with perfstats.timer('sqlite'):
+    return refresh_messages(sqlcur, refresh_uids, refresh_labels, refresh_flags)
+
+def refresh_messages(sqlcur, refresh_uids, refresh_labels, refresh_flags):
+  # Each UID is looked up in uids once here, so the statements below find
+  # the rows of a message through the primary keys of the temp tables.
+  sqlcur.executescript("""
+     CREATE TEMP TABLE IF NOT EXISTS refresh_messages
+         (message_num INTEGER PRIMARY KEY, gmail_msgid INTEGER, gmail_thrid INTEGER);
+     CREATE TEMP TABLE IF NOT EXISTS refresh_labels
+         (message_num INTEGER, label TEXT, PRIMARY KEY (message_num, label));
+     CREATE TEMP TABLE IF NOT EXISTS refresh_flags
+         (message_num INTEGER, flag TEXT, PRIMARY KEY (message_num, flag));
+     DELETE FROM refresh_messages;
+     DELETE FROM refresh_labels;
+     DELETE FROM refresh_flags;
+  """)
+  sqlcur.executemany("""INSERT OR IGNORE INTO refresh_messages (message_num, gmail_msgid, gmail_thrid)
+      SELECT message_num, ?, ? FROM uids WHERE uid = ?""",
+                     ((gmail_msgid, gmail_thrid, uid) for uid, gmail_msgid, gmail_thrid in refresh_uids))
+  sqlcur.executemany("""INSERT OR IGNORE INTO refresh_labels (message_num, label)
+      SELECT message_num, ? FROM uids WHERE uid = ?""",
+                     ((label, uid) for uid, label in refresh_labels))
+  sqlcur.executemany("""INSERT OR IGNORE INTO refresh_flags (message_num, flag)
+      SELECT message_num, ? FROM uids WHERE uid = ?""",
+                     ((flag, uid) for uid, flag in refresh_flags))
+  sqlcur.execute("""DELETE FROM labels
+              WHERE message_num IN (SELECT message_num FROM refresh_messages)
+              AND NOT EXISTS (SELECT 1 FROM refresh_labels
+                 WHERE refresh_labels.message_num = labels.message_num
+                   AND refresh_labels.label = labels.label)""")
+  sqlcur.execute("""DELETE FROM flags
+              WHERE message_num IN (SELECT message_num FROM refresh_messages)
+              AND NOT EXISTS (SELECT 1 FROM refresh_flags
+                 WHERE refresh_flags.message_num = flags.message_num
+                   AND refresh_flags.flag = flags.flag)""")
+  sqlcur.execute("""INSERT OR IGNORE INTO labels (message_num, label)
+      SELECT message_num, label FROM refresh_labels""")
+  sqlcur.execute("""INSERT OR IGNORE INTO flags (message_num, flag)
+      SELECT message_num, flag FROM refresh_flags""")
+  sqlcur.execute("""UPDATE messages SET
+      gmail_msgid = (SELECT gmail_msgid FROM refresh_messages
+                      WHERE refresh_messages.message_num = messages.message_num),
+      gmail_thrid = (SELECT gmail_thrid FROM refresh_messages
+                      WHERE refresh_messages.message_num = messages.message_num)
+      WHERE gmail_msgid IS NULL
+        AND message_num IN (SELECT message_num FROM refresh_messages)""")
+  return len(refresh_uids)
+
+# IMAP SEARCH keys of the system flags
+flag_search_keys = {'\\Seen': 'SEEN',
+                    '\\Flagged': 'FLAGGED',
+                    '\\Answered': 'ANSWERED',
+                    '\\Draft': 'DRAFT',
+                    '\\Deleted': 'DELETED',
+                    '\\Recent': 'RECENT'}
+
+def get_refresh_searches(imapconn, sqlcur):
+  '''
+  Args:
+    imapconn: object, an authenticated IMAP connection
+    sqlcur: object, a cursor of the backup database
+
+  Returns:
+    tuple, list of (label, search criteria) and list of (flag, search criteria)
+    for every label and flag of the account or the backup, so labels that
+    were deleted in Gmail are searched and removed too
+  '''
+  labels = {}
+  for (label,) in sqlcur.execute('SELECT DISTINCT label FROM labels'):
+    labels[gimaplib.GImapUnquote(label)] = label
+  for label in gimaplib.GImapGetLabels(imapconn):
+    labels.setdefault(gimaplib.GImapUnquote(label), label)
+  label_searches = [(label, ('X-GM-LABELS', label)) for label in labels.values()]
+  flags = set(['\\Seen', '\\Flagged', '\\Answered', '\\Draft'])
+  flags.update(flag for (flag,) in sqlcur.execute('SELECT DISTINCT flag FROM flags'))
+  flag_searches = []
+  for flag in flags:
+    if flag in flag_search_keys:
+      flag_searches.append((flag, (flag_search_keys[flag],)))
+    elif not flag.startswith('\\'):
+      flag_searches.append((flag, ('KEYWORD', flag)))
+  return label_searches, flag_searches
+
+def search_with_retry(imapconn, reconnect, criteria):
+  def search(imapconn):
+    with perfstats.timer('imap_command'):
+      return gimaplib.GImapUIDSearch(imapconn, *criteria)
+  return with_retry(imapconn, reconnect, search)
+
+def refresh_by_search(imapconn, reconnect, sqlconn, refresh_uids, label_searches, flag_searches):
+  '''
+  Args:
+    imapconn: object, an authenticated IMAP connection with ALL_MAIL selected
+    reconnect: function, returns a new connection with ALL_MAIL selected
+    sqlconn: object, the connection to the backup database
+    refresh_uids: UIDSet, the backed up messages to refresh
+    label_searches, flag_searches: lists returned by get_refresh_searches()
+
+  Returns:
+    object, the (possibly reconnected) IMAP connection
+
+  Instead of fetching the labels and flags of every message, runs one UID
+  SEARCH per label and flag and reconciles the returned UIDs with the labels
+  and flags tables in bulk, so the work grows with the number of labels
+  rather than the number of messages.
+  '''
+  sqlcur = sqlconn.cursor()
+  sqlcur.executescript('''
+     CREATE TEMP TABLE IF NOT EXISTS refresh_scope (uid INTEGER PRIMARY KEY);
+     CREATE TEMP TABLE IF NOT EXISTS search_uids (uid INTEGER PRIMARY KEY);
+     DELETE FROM refresh_scope;
+     CREATE INDEX IF NOT EXISTS labelnameidx ON labels (label);
+     CREATE INDEX IF NOT EXISTS flagnameidx ON flags (flag);
+  ''')
+  sqlcur.executemany('INSERT INTO refresh_scope (uid) VALUES (?)',
+                     ((uid,) for uid in refresh_uids))
+  searches = ([('labels', 'label', value, criteria) for value, criteria in label_searches] +
+              [('flags', 'flag', value, criteria) for value, criteria in flag_searches])
+  refreshed = 0
+  for table, column, value, criteria in searches:
+    imapconn, search_uids = search_with_retry(imapconn, reconnect, criteria)
+    with perfstats.timer('sqlite'):
+      sqlcur.execute('DELETE FROM search_uids')
+      sqlcur.executemany('INSERT INTO search_uids (uid) VALUES (?)',
+                         ((uid,) for uid in search_uids.intersection(refresh_uids)))
+      sqlcur.execute('''DELETE FROM %s WHERE %s = ?
+           AND message_num IN (SELECT message_num FROM uids NATURAL JOIN refresh_scope)
+           AND message_num NOT IN (SELECT message_num FROM uids NATURAL JOIN search_uids)'''
+                     % (table, column), (value,))
+      sqlcur.execute('''INSERT OR IGNORE INTO %s (message_num, %s)
+           SELECT message_num, ? FROM uids NATURAL JOIN search_uids''' % (table, column),
+                     (value,))
+    with perfstats.timer('commit'):
+      sqlconn.commit()
+    refreshed += 1
+    # every search refreshes part of all the messages, count them with the last one
+    perfstats.batch(len(refresh_uids) if refreshed == len(searches) else 0)
+    restart_line()
+    sys.stdout.write("refreshed %s of %s labels and flags" % (refreshed, len(searches)))
+    sys.stdout.flush()
+  # Only the searches above look labels and flags up by name, backups would
+  # just keep the indexes up to date on every insert
+  sqlcur.executescript('''
+     DROP INDEX labelnameidx;
+     DROP INDEX flagnameidx;
+  ''')
+  return imapconn
+
+def save_message_batch(d, sqlcur, backup_folder, uidvalidity, header_parser, store_layout='dated',
+                       codec=None):
+  saved_messages = [save_message(everything_else_string, (full_message,),
+                                 backup_folder, uidvalidity, header_parser, store_layout,
+                                 codec=codec)
+                    for everything_else_string, full_message in (x for x in d if x != ')')]
+  record_message_batch(sqlcur, saved_messages)
+  return len(saved_messages)
+
+def commit_converted(sqlconn, backup_folder, old_filenames):
+  msgstore.sync_packs(backup_folder)
+  sqlconn.commit()
+  for filename in old_filenames:
+    # segments hold other messages, they are removed once all are moved
+    if msgstore.get_layout(filename) != 'pack':
+      os.remove(os.path.join(backup_folder, filename))
+
+def compact_messages(sqlconn, backup_folder, store_compression, layout, threads):
+  '''
+  Args:
+    sqlconn: object, the connection to the backup database
+    backup_folder: string, the backup folder
+    store_compression: string, none or gzip to convert messages to, None to keep their codec
+    layout: string, hashed or pack to also move messages to that layout, None to keep it
+    threads: int, number of threads converting files
+
+  Returns:
+    int, the number of messages converted
+
+  Files are read, converted and written by a pool of threads so the disk is
+  kept busy, while the database is only updated from this thread. An old file
+  is removed once the database no longer points to it, so an interrupted
+  compact can simply be run again.
+  '''
+  keep_codec = store_compression is None
+  codec = get_codec(store_compression)
+  # Create an index on the file name to speed up the updates
+  sqlconn.execute('CREATE INDEX IF NOT EXISTS filenameidx ON messages (message_filename)')
+  to_convert = [stored_message for stored_message in sqlconn.execute('''
+      SELECT DISTINCT message_filename, message_offset, message_length, message_codec
+        FROM messages''')
+      if ((not keep_codec and stored_message[3] != codec) or
+          (layout is not None and msgstore.get_layout(stored_message[0]) != layout))]
+  convert_count = len(to_convert)
+  print "GYB needs to convert %s messages" % convert_count
+  # the converted messages are appended to other segments than their old ones,
+  # which are removed once empty
+  msgstore.retire_segments(backup_folder, set(stored_message[0] for stored_message in to_convert
+                                              if msgstore.get_layout(stored_message[0]) == 'pack'))
+  work = Queue.Queue()
+  for stored_message in to_convert:
+    work.put(stored_message)
+  results = Queue.Queue()
+  def convert_worker():
+    while True:
+      try:
+        filename, offset, length, old_codec = stored_message = work.get_nowait()
+      except Queue.Empty:
+        return
+      new_codec = old_codec if keep_codec else codec
+      try:
+        if os.path.isfile(os.path.join(backup_folder, filename)):
+          converted_message = msgstore.convert_message(backup_folder, filename, old_codec,
+                                                       new_codec, layout, offset, length)
+          converted_message += (new_codec,)
+        else:
+          converted_message = None
+        results.put((stored_message, converted_message, None))
+      except Exception, e:
+        # every message must put one result, the main thread waits for them
+        results.put((stored_message, None, e))
+  for i in range(max(threads, 1)):
+    worker = threading.Thread(target=convert_worker)
+    worker.daemon = True
+    worker.start()
+  converted = 0
+  commit_every = 100
+  pending = []
+  old_segments = set()
+  for i in xrange(convert_count):
+    (filename, offset, length, old_codec), converted_message, error = results.get()
+    if error is not None:
+      print '\nWARNING! file %s could not be converted: %s' % (os.path.join(backup_folder, filename), error)
+      continue
+    if converted_message is None:
+      print '\nWARNING! file %s does not exist, it will be skipped.' % os.path.join(backup_folder, filename)
+      continue
+    sqlconn.execute('''
+        UPDATE messages SET message_filename = ?, message_offset = ?,
+                            message_length = ?, message_codec = ?
+          WHERE message_filename = ? AND message_offset IS ?''',
+        converted_message + (filename, offset))
+    pending.append(filename)
+    if msgstore.get_layout(filename) == 'pack':
+      old_segments.add(filename)
+    converted += 1
+    if len(pending) >= commit_every:
+      commit_converted(sqlconn, backup_folder, pending)
+      pending = []
+      restart_line()
+      sys.stdout.write("converted %s of %s messages" % (converted, convert_count))
+      sys.stdout.flush()
+  commit_converted(sqlconn, backup_folder, pending)
+  msgstore.sync_packs(backup_folder, close=True)
+  msgstore.close_segment_maps()
+  for filename in old_segments:
+    if not sqlconn.execute('SELECT 1 FROM messages WHERE message_filename = ? LIMIT 1',
+                           (filename,)).fetchone():
+      os.remove(os.path.join(backup_folder, filename))
+  # Only compact looks messages up by file name, backups would just keep the
+  # index up to date on every insert
+  sqlconn.execute('DROP INDEX filenameidx')
+  sqlconn.commit()
+  restart_line()
+  sys.stdout.write("converted %s of %s messages" % (converted, convert_count))
+  print "\n"
+  return converted
+
 def main(argv):
   options_parser = SetupOptionParser()
   (options, args) = options_parser.parse_args(argv)
   if options.version:
     print 'Got Your Back %s' % __version__
     sys.exit(0)
+  perfstats.start(options.stats_file, options.action)
   if not options.email:
     options_parser.print_help()
     print "ERROR: --email or -e is required."
@@ -498,12 +1819,16 @@ def main(argv):
       os.remove(cfgFile)
       sys.exit(9)
 
-  imapconn = gimaplib.ImapConnect(generateXOAuthString(key, secret, options.email, options.two_legged), options.debug, options.compress) # dynamically generate the xoauth_string since they expire after 10 minutes
+  with perfstats.timer('connect'):
+    imapconn = connect_imap(key, secret, options, options.compress)
+  tuner = None
+  if options.adaptive_compress and options.compress:
+    tuner = gimaplib.CompressionTuner()
   if not os.path.isdir(options.folder):
     if options.action == 'backup':
       os.mkdir(options.folder)
-    elif options.action == 'restore':
-      print 'Error: Folder %s does not exist. Cannot restore.' % options.folder
+    elif options.action in ('restore', 'prune', 'compact'):
+      print 'Error: Folder %s does not exist. Cannot %s.' % (options.folder, options.action)
       sys.exit(3)
 
   global ALL_MAIL
@@ -529,6 +1854,7 @@ def main(argv):
     sqlconn = sqlite3.connect(sqldbfile, detect_types=sqlite3.PARSE_DECLTYPES)
     sqlconn.text_factory = str
     sqlcur = sqlconn.cursor()
+    set_db_pragmas(sqlcur, options)
     if newDB:
       initializeDB(sqlcur, sqlconn, options.email, uidvalidity)
     db_settings = get_db_settings(sqlcur)
@@ -538,17 +1864,48 @@ def main(argv):
           db_settings['db_version'] <  __db_schema_version__):
         convertDB(sqlconn, uidvalidity, db_settings['db_version'])
         db_settings = get_db_settings(sqlcur)
-      if options.action == 'reindex':
-        getMessageIDs(sqlconn, options.folder)
+      if options.action == 'prune':
+        referenced_filenames = set(os.path.normpath(filename) for (filename,) in
+            sqlconn.execute('SELECT DISTINCT message_filename FROM messages'))
+        removed_files, removed_bytes = msgstore.prune_blobs(options.folder, referenced_filenames)
+        print "Removed %s unreferenced message files (%s bytes)" % (removed_files, removed_bytes)
+        sys.exit(0)
+      if options.action == 'compact':
+        if options.store_layout == 'dated':
+          print "Error: compact can only move messages to the hashed or pack layout."
+          sys.exit(3)
+        store_compression = options.store_compression
+        if not store_compression and not options.store_layout:
+          store_compression = 'gzip'
+        compact_messages(sqlconn, options.folder, store_compression,
+                         options.store_layout, options.threads)
+        sys.exit(0)
+      # With the permanent X-GM-MSGID of every message the backup can be
+      # matched to new UIDs right away
+      remap_uids = (options.action == 'backup' and
+                    db_settings['uidvalidity'] != uidvalidity and
+                    not sqlconn.execute(
+                      'SELECT 1 FROM messages WHERE gmail_msgid IS NULL LIMIT 1').fetchone())
+      if remap_uids:
+        print "Gmail UIDs changed, matching the backup to the new UIDs"
+      if options.action == 'reindex' or remap_uids:
+        if options.action == 'reindex':
+          getMessageIDs(sqlconn, options.folder)
         rebuildUIDTable(imapconn, sqlconn)
+        perfstats.batch(sqlconn.execute('SELECT count(*) FROM uids').fetchone()[0])
         sqlconn.execute('''
             UPDATE settings SET value = ? where name = 'uidvalidity'
         ''', ((uidvalidity),))
+        # Mod-sequences and the highest UID don't carry over to the new UIDs
+        sqlconn.execute("DELETE FROM settings WHERE name IN ('highestmodseq', 'highestuid')")
         sqlconn.commit()
-        sys.exit(0)
+        if options.action == 'reindex':
+          perfstats.finish()
+          sys.exit(0)
+        db_settings = get_db_settings(sqlcur)
 
       if db_settings['uidvalidity'] != uidvalidity:
-        print "Because of changes on the Gmail server, this folder cannot be used for incremental backups."
+        print "Because of changes on the Gmail server, this folder cannot be used for incremental backups. Run GYB with --action reindex first."
         sys.exit(3)
 
   if options.action_labels:
@@ -562,214 +1919,196 @@ def main(argv):
   # BACKUP #
   if options.action == 'backup':
     imapconn.select(ALL_MAIL, readonly=True)
-    messages_to_process = getMessagesToBackupList(imapconn, options.gmail_search)
+    highest_modseq = gimaplib.GImapHighestModSeq(imapconn)
+    new_only = options.new_only and 'highestuid' in db_settings
+    if new_only:
+      # Every message up to the highest UID of the last full backup is
+      # already backed up, so only newer messages need to be found.
+      highest_uid = int(db_settings['highestuid'])
+      print "GYB is looking for messages after UID %s" % highest_uid
+      # n:* always matches the newest message even if its UID is below n
+      messages_to_process = getMessagesToBackupList(
+          imapconn, options.gmail_search, '%d:*' % (highest_uid + 1)).above(highest_uid)
+    else:
+      messages_to_process = getMessagesToBackupList(imapconn, options.gmail_search)
     backup_path = options.folder
     if not os.path.isdir(backup_path):
       os.mkdir(backup_path)
-    messages_to_backup = []
-    messages_to_refresh = []
     #Determine which messages from the search we haven't processed before.
     print "GYB needs to examine %s messages" % len(messages_to_process)
-    for message_num in messages_to_process:
-      if newDB:
-        # short circuit the db and filesystem checks to save unnecessary DB and Disk IO
-        messages_to_backup.append(message_num)
-        continue
-      if message_is_backed_up(message_num, sqlcur, sqlconn, options.folder):
-        messages_to_refresh.append(message_num)
-      else:
-        messages_to_backup.append(message_num)
+    if newDB:
+      # short circuit the db and filesystem checks to save unnecessary DB and Disk IO
+      messages_to_backup = messages_to_process
+      messages_to_refresh = gimaplib.UIDSet()
+    else:
+      messages_to_backup, messages_to_refresh = get_backed_up_messages(
+          messages_to_process, sqlcur, options.folder, options.trust_db)
     print "GYB already has a backup of %s messages" % (len(messages_to_process) - len(messages_to_backup))
     backup_count = len(messages_to_backup)
     print "GYB needs to backup %s messages" % backup_count
     messages_at_once = options.batch_size
     backed_up_messages = 0
     header_parser = email.parser.HeaderParser()
-    for working_messages in batch(messages_to_backup, messages_at_once):
-      #Save message content
-      batch_string = ','.join(working_messages)
-      bad_count = 0
-      while True:
-        try:
-          r, d = imapconn.uid('FETCH', batch_string, '(X-GM-LABELS INTERNALDATE FLAGS BODY.PEEK[])')
-          if r != 'OK':
-            bad_count = bad_count + 1
-            if bad_count > 7:
-              print "\nError: failed to retrieve messages."
-              print "%s %s" % (r, d)
-              sys.exit(5)
-            sleep_time = math.pow(2, bad_count)
-            sys.stdout.write("\nServer responded with %s %s, will retry in %s seconds" % (r, d, str(sleep_time)))
-            time.sleep(sleep_time) # sleep 2 seconds, then 4, 8, 16, 32, 64, 128
-            imapconn = gimaplib.ImapConnect(generateXOAuthString(key, secret, options.email, options.two_legged), options.debug, options.compress)
-            imapconn.select(ALL_MAIL, readonly=True)
-            continue
-          break
-        except imaplib.IMAP4.abort, e:
-          print 'imaplib.abort error:%s, retrying...' % e
-          imapconn = gimaplib.ImapConnect(generateXOAuthString(key, secret, options.email, options.two_legged), options.debug, options.compress)
-          imapconn.select(ALL_MAIL, readonly=True)
-        except socket.error, e:
-          print 'socket.error:%s, retrying...' % e
-          imapconn = gimaplib.ImapConnect(generateXOAuthString(key, secret, options.email, options.two_legged), options.debug, options.compress)
-          imapconn.select(ALL_MAIL, readonly=True)
-      for everything_else_string, full_message in (x for x in d if x != ')'):
-        search_results = re.search('X-GM-LABELS \((.*)\) UID ([0-9]*) (INTERNALDATE \".*\") (FLAGS \(.*\))', everything_else_string)
-        labels = shlex.split(search_results.group(1), posix=False)
-        uid = search_results.group(2)
-        message_date_string = search_results.group(3)
-        message_flags_string = search_results.group(4)
-        message_date = imaplib.Internaldate2tuple(message_date_string)
-        time_seconds_since_epoch = time.mktime(message_date)
-        message_internal_datetime = datetime.datetime.fromtimestamp(time_seconds_since_epoch)
-        message_flags = imaplib.ParseFlags(message_flags_string)
-        message_file_name = "%s-%s.eml" % (uidvalidity, uid)
-        message_rel_path = os.path.join(str(message_date.tm_year), 
-                                        str(message_date.tm_mon), 
-                                        str(message_date.tm_mday))
-        message_rel_filename = os.path.join(message_rel_path, 
-                                            message_file_name)
-        message_full_path = os.path.join(options.folder, 
-                                         message_rel_path)
-        message_full_filename = os.path.join(options.folder, 
-                                             message_rel_filename)
-        if not os.path.isdir(message_full_path):
-          os.makedirs(message_full_path)
-        f = open(message_full_filename, 'wb')
-        f.write(full_message)
-        f.close()
-        m = header_parser.parsestr(full_message, True)
-        message_from = m.get('from')
-        message_to = m.get('to')
-        message_subj = m.get('subject')
-        message_id = m.get('message-id')
-        sqlcur.execute("""
-             INSERT INTO messages (
-                         message_filename, 
-                         message_to, 
-                         message_from, 
-                         message_subject, 
-                         message_internaldate,
-                         rfc822_msgid) VALUES (?, ?, ?, ?, ?, ?)""", 
-                        (message_rel_filename, 
-                         message_to, 
-                         message_from, 
-                         message_subj, 
-                         message_internal_datetime,
-                         message_id))
-        message_num = sqlcur.lastrowid
-        sqlcur.execute("""
-             REPLACE INTO uids (message_num, uid) VALUES (?, ?)""", 
-                               (message_num, uid))
-        for label in labels:
-          sqlcur.execute("""
-             INSERT INTO labels (message_num, label) VALUES (?, ?)""",  
-                                (message_num, label))
-        for flag in message_flags:
-          sqlcur.execute("""
-             INSERT INTO flags (message_num, flag) VALUES (?, ?)""", 
-                               (message_num, flag))
-        backed_up_messages += 1
-
-      sqlconn.commit()
+    reconnect = lambda: connect_all_mail(key, secret, options, tuner=tuner)
+    if options.batch_bytes and backup_count:
+      print "Sizing %s messages" % backup_count
+      batches = iter(list(batch_by_size(imapconn, messages_to_backup, options.batch_bytes)))
+    else:
+      batches = messages_to_backup.batches(messages_at_once)
+    codec = get_codec(options.store_compression)
+    store_layout = options.store_layout or 'dated'
+    if options.stream:
+      stream_message = lambda envelope, literal: save_message(envelope, literal, options.folder, uidvalidity, header_parser,
+                                                              store_layout, 1048576, codec)
+    else:
+      stream_message = None
+    fetcher = BatchFetcher(imapconn, reconnect, batches,
+                           '(X-GM-LABELS X-GM-MSGID X-GM-THRID INTERNALDATE FLAGS BODY.PEEK[])',
+                           options.fetch_ahead, options.connections, stream_message, tuner)
+    if options.fetch_ahead > 0 or options.connections > 1:
+      fetcher.start()
+    for working_messages, d in fetcher:
+      if options.stream:
+        record_message_batch(sqlcur, d)
+        backed_up_messages += len(d)
+      else:
+        backed_up_messages += save_message_batch(d, sqlcur, options.folder,
+                                                 uidvalidity, header_parser,
+                                                 store_layout, codec)
+      # messages appended to pack segments must be on disk before they're recorded
+      with perfstats.timer('fsync'):
+        msgstore.sync_packs(options.folder)
+      with perfstats.timer('commit'):
+        sqlconn.commit()
+      perfstats.batch(len(working_messages))
       restart_line()
       sys.stdout.write("backed up %s of %s messages" % (backed_up_messages, backup_count))
       sys.stdout.flush()
+    imapconn = fetcher.imapconn
+    msgstore.sync_packs(options.folder, close=True)
     print "\n"
+    # Only a backup of the whole mailbox guarantees no older message is missing
+    if messages_to_process and not options.gmail_search:
+      sqlcur.execute("REPLACE INTO settings (name, value) VALUES ('highestuid', ?)",
+                     (messages_to_process.max(),))
+      sqlconn.commit()
  
     if not options.refresh:
-      messages_to_refresh = []
+      messages_to_refresh = gimaplib.UIDSet()
     backed_up_messages = 0
-    backup_count = len(messages_to_refresh)
-    print "GYB needs to refresh %s messages" % backup_count
-    sqlcur.executescript("""
-       CREATE TEMP TABLE current_labels (label TEXT);
-       CREATE TEMP TABLE current_flags (flag TEXT);
-    """)
+    refresh_parts = '(X-GM-LABELS X-GM-MSGID X-GM-THRID FLAGS)'
     messages_at_once *= 100
-    for working_messages in batch(messages_to_refresh, messages_at_once):
+    changed_only = (options.refresh and highest_modseq and
+                    'highestmodseq' in db_settings and
+                    options.refresh_strategy != 'labels')
+    if new_only and options.refresh and not changed_only:
+      # the search only listed new messages, so refresh everything backed up
+      messages_to_refresh = gimaplib.UIDSet(uid for (uid,) in sqlcur.execute(
+                               'SELECT uid FROM uids WHERE uid <= ?', (highest_uid,)))
+    refresh_by_labels = False
+    if options.refresh and not changed_only and options.refresh_strategy != 'fetch' and messages_to_refresh:
+      label_searches, flag_searches = get_refresh_searches(imapconn, sqlcur)
+      # A search costs a round trip but sends only the UIDs that match, while
+      # fetching returns a hundred bytes or so for every message.
+      refresh_by_labels = (options.refresh_strategy == 'labels' or
+                           (len(label_searches) + len(flag_searches)) * 100 <= len(messages_to_refresh))
+    if changed_only:
+      # CONDSTORE: only messages whose labels or flags changed since the last
+      # full backup are returned by the server.
+      print "GYB needs to refresh messages changed since the last backup"
+      refresh_batches = ['1:*']
+      refresh_parts += ' (CHANGEDSINCE %s)' % db_settings['highestmodseq']
+    elif refresh_by_labels:
+      print "GYB needs to refresh %s messages with %s label and flag searches" % (
+          len(messages_to_refresh), len(label_searches) + len(flag_searches))
+      imapconn = refresh_by_search(imapconn, reconnect, sqlconn, messages_to_refresh,
+                                   label_searches, flag_searches)
+      refresh_batches = []
+    else:
+      backup_count = len(messages_to_refresh)
+      print "GYB needs to refresh %s messages" % backup_count
+      refresh_batches = messages_to_refresh.batches(messages_at_once)
+    for working_messages in refresh_batches:
       #Save message content
-      batch_string = ','.join(working_messages)
-      bad_count = 0
-      while True:
-        try:
-          r, d = imapconn.uid('FETCH', batch_string, '(X-GM-LABELS FLAGS)')
-          if r != 'OK':
-            bad_count = bad_count + 1
-            if bad_count > 7:
-              print "\nError: failed to retrieve messages."
-              print "%s %s" % (r, d)
-              sys.exit(5)
-            sleep_time = math.pow(2, bad_count)
-            sys.stdout.write("\nServer responded with %s %s, will retry in %s seconds" % (r, d, str(sleep_time)))
-            time.sleep(sleep_time) # sleep 2 seconds, then 4, 8, 16, 32, 64, 128
-            imapconn = gimaplib.ImapConnect(generateXOAuthString(key, secret, options.email, options.two_legged), options.debug, options.compress)
-            imapconn.select(ALL_MAIL, readonly=True)
-            continue
-          break
-        except imaplib.IMAP4.abort, e:
-          print 'imaplib.abort error:%s, retrying...' % e
-          imapconn = gimaplib.ImapConnect(generateXOAuthString(key, secret, options.email, options.two_legged), options.debug, options.compress)
-          imapconn.select(ALL_MAIL, readonly=True)
-        except socket.error, e:
-          print 'socket.error:%s, retrying...' % e
-          imapconn = gimaplib.ImapConnect(generateXOAuthString(key, secret, options.email, options.two_legged), options.debug, options.compress)
-          imapconn.select(ALL_MAIL, readonly=True)
-      for results in d:
-        search_results = re.search('X-GM-LABELS \((.*)\) UID ([0-9]*) (FLAGS \(.*\))', results)
-        labels = shlex.split(search_results.group(1), posix=False)
-        uid = search_results.group(2)
-        message_flags_string = search_results.group(3)
-        message_flags = imaplib.ParseFlags(message_flags_string)
-        sqlcur.execute('DELETE FROM current_labels')
-        sqlcur.execute('DELETE FROM current_flags')
-        sqlcur.executemany(
-           'INSERT INTO current_labels (label) VALUES (?)',
-              ((label,) for label in labels))
-        sqlcur.executemany(
-           'INSERT INTO current_flags (flag) VALUES (?)',
-              ((flag,) for flag in message_flags))
-        sqlcur.execute("""DELETE FROM labels where message_num = 
-                   (SELECT message_num from uids where uid = ?)
-                    AND label NOT IN current_labels""", ((uid),))
-        sqlcur.execute("""DELETE FROM flags where message_num = 
-                   (SELECT message_num from uids where uid = ?)
-                    AND flag NOT IN current_flags""", ((uid),))
-        sqlcur.execute("""INSERT INTO labels (message_num, label) 
-            SELECT message_num, label from uids, current_labels 
-               WHERE uid = ? AND label NOT IN 
-               (SELECT label FROM labels 
-                  WHERE message_num = uids.message_num)""", ((uid),))
-        sqlcur.execute("""INSERT INTO flags (message_num, flag) 
-            SELECT message_num, flag from uids, current_flags 
-               WHERE uid = ? AND flag NOT IN 
-               (SELECT flag FROM flags 
-                  WHERE message_num = uids.message_num)""", ((uid),))
-        backed_up_messages += 1
-
-      sqlconn.commit()
+      imapconn, d = fetch_with_retry(imapconn, reconnect, working_messages, refresh_parts)
+      if tuner and tuner.sample(imapconn):
+        imapconn.logout()
+        imapconn = reconnect()
+      d = [results for results in d if results]
+      if changed_only:
+        backup_count = len(d)
+      refreshed_messages = refresh_message_batch(d, sqlcur)
+      backed_up_messages += refreshed_messages
+      with perfstats.timer('commit'):
+        sqlconn.commit()
+      perfstats.batch(refreshed_messages)
       restart_line()
       sys.stdout.write("refreshed %s of %s messages" % (backed_up_messages, backup_count))
       sys.stdout.flush()
     print "\n"
+    # Changes are only tracked from here on if every message was refreshed
+    if highest_modseq and options.refresh and not options.gmail_search:
+      sqlcur.execute("REPLACE INTO settings (name, value) VALUES ('highestmodseq', ?)",
+                     (highest_modseq,))
+      sqlconn.commit()
  
   # RESTORE #
   elif options.action == 'restore':
     imapconn.select(ALL_MAIL)  # read/write!
+    first_uid = imapconn.response('UIDNEXT')[1][0]
+    if first_uid is not None:
+      first_uid = int(first_uid)
     resumedb = os.path.join(options.folder, 
                             "%s-restored.sqlite" % options.email)
     sqlcur.execute('ATTACH ? as resume', (resumedb,))
+    # progress is committed in checkpoints, with WAL each one only appends to
+    # and syncs the log
+    sqlcur.execute('PRAGMA resume.journal_mode = WAL')
+    sqlcur.execute('PRAGMA resume.synchronous = FULL')
+    # restores don't convert the database, older schemas have no codec or offsets
+    if db_settings['db_version'] < '6':
+      codec_columns = 'NULL, NULL, NULL'
+    elif db_settings['db_version'] < '7':
+      codec_columns = 'message_codec, NULL, NULL'
+    else:
+      codec_columns = 'message_codec, message_offset, message_length'
+    if db_settings['db_version'] < '4':
+      msgid_column = 'NULL'
+    else:
+      msgid_column = 'rfc822_msgid'
     sqlcur.executescript('''
        CREATE TABLE IF NOT EXISTS resume.restored_messages 
-                      (message_num INTEGER PRIMARY KEY); 
-       CREATE TEMP TABLE skip_messages (message_num INTEGER PRIMARY KEY);
+                      (message_num INTEGER PRIMARY KEY, restored_uid INTEGER,
+                       labeled INTEGER DEFAULT 0); 
+       CREATE TABLE IF NOT EXISTS resume.restore_settings
+                      (name TEXT PRIMARY KEY, value TEXT);
     ''')
-    if options.resume:
-      sqlcur.execute('''
-         INSERT INTO skip_messages SELECT message_num from restored_messages
+    # resume databases of older versions have no UIDs, the messages in them
+    # got their labels right after they were appended
+    resume_columns = [column[1] for column in
+                      sqlcur.execute('PRAGMA resume.table_info(restored_messages)')]
+    if 'restored_uid' not in resume_columns:
+      sqlcur.executescript('''
+         ALTER TABLE resume.restored_messages ADD COLUMN restored_uid INTEGER;
+         ALTER TABLE resume.restored_messages ADD COLUMN labeled INTEGER DEFAULT 0;
       ''')
+    # messages found by their Message-ID below this UID are not ours, see
+    # find_restored()
+    if not options.resume and first_uid is not None:
+      sqlcur.execute('''REPLACE INTO resume.restore_settings (name, value)
+                        VALUES ('first_uid', ?)''', (first_uid,))
+    # The messages are streamed from a connection of their own, a commit of
+    # the resume database on sqlconn would reset any cursor of sqlconn.
+    readconn = sqlite3.connect(sqldbfile, detect_types=sqlite3.PARSE_DECLTYPES)
+    readconn.text_factory = str
+    readcur = readconn.cursor()
+    readcur.execute('CREATE TEMP TABLE skip_messages (message_num INTEGER PRIMARY KEY)')
+    if options.resume:
+      readcur.executemany('INSERT INTO skip_messages (message_num) VALUES (?)',
+                          sqlconn.execute('SELECT message_num from restored_messages'))
+    restore_where = 'message_num NOT IN skip_messages'
     if options.action_labels:
-      sqlcur.execute(
+      readcur.execute(
          'CREATE TEMP TABLE restore_labels (label TEXT COLLATE NOCASE)')
       for label in options.action_labels:
         if label == 'inbox':
@@ -784,85 +2123,86 @@ def main(argv):
           label = '\\Draft'
         elif label == 'important':
           label = '\\Important'
-        sqlcur.execute(
+        readcur.execute(
           'INSERT INTO restore_labels (label) VALUES(?)',
                          ((label),))
-      sqlcur.execute('''
-        SELECT message_num, message_internaldate, message_filename FROM messages
-          WHERE message_num IN 
-          (SELECT DISTINCT message_num from restore_labels NATURAL JOIN labels)
-          AND message_num NOT IN skip_messages
-      ''')
-    else:
-      sqlcur.execute('''
-        SELECT message_num, message_internaldate, message_filename FROM messages
-          WHERE message_num NOT IN skip_messages
-      ''') # All messages
-    messages_to_restore_results = sqlcur.fetchall()
-    restore_count = len(messages_to_restore_results)
+      restore_where += '''
+          AND message_num IN 
+          (SELECT DISTINCT message_num from restore_labels NATURAL JOIN labels)'''
+    readcur.execute('SELECT count(*) FROM messages WHERE %s' % restore_where)
+    restore_count = readcur.fetchone()[0]
     if restore_count == 0 and options.action_labels:
       print "No messages found in label: %s" % options.action_labels
       print "Available labels are:"
       for label in sqlcur.execute(
                    'SELECT DISTINCT label COLLATE NOCASE FROM labels'):
         print "\t%s" % label
-    current = 0
-    for x in messages_to_restore_results:
-      restart_line()
-      current += 1
-      sys.stdout.write("restoring message %s of %s" % (current, restore_count))
-      sys.stdout.flush()
-      message_num = x[0]
-      message_internaldate = x[1]
-      message_internaldate_seconds = time.mktime(message_internaldate.timetuple())
-      message_filename = x[2]
-      if not os.path.isfile(os.path.join(options.folder, message_filename)):
-        print 'WARNING! file %s does not exist for message %s' % (os.path.join(options.folder, message_filename), message_num)
-        print '  this message will be skipped.'
-        continue
-      f = open(os.path.join(options.folder, message_filename), 'rb')
-      full_message = f.read()
-      f.close()
-      labels_query = sqlcur.execute('SELECT DISTINCT label FROM labels WHERE message_num = ?', (message_num,))
-      labels_results = sqlcur.fetchall()
-      labels = []
-      for l in labels_results:
-        labels.append(l[0].replace('\\','\\\\').replace('"','\\"'))
-      if options.label_restored:
-        labels.append(options.label_restored)
-      flags_query = sqlcur.execute('SELECT DISTINCT flag FROM flags WHERE message_num = ?', (message_num,))
-      flags_results = sqlcur.fetchall()
-      flags = []
-      for f in flags_results:
-        flags.append(f[0])
-      flags_string = ' '.join(flags)
-      while True:
-        try:
-          r, d = imapconn.append(ALL_MAIL, flags_string, message_internaldate_seconds, full_message)
-          if r != 'OK':
-            print '\nError: %s %s' % (r,d)
-            sys.exit(5)
-          restored_uid = int(re.search('^[APPENDUID [0-9]* ([0-9]*)] \(Success\)$', d[0]).group(1))
-          if len(labels) > 0:
-            labels_string = '("'+'" "'.join(labels)+'")'
-            r, d = imapconn.uid('STORE', restored_uid, '+X-GM-LABELS', labels_string)
-            if r != 'OK':
-              print '\nGImap Set Message Labels Failed: %s %s' % (r, d)
-              sys.exit(33)
-          break
-        except imaplib.IMAP4.abort, e:
-          print '\nimaplib.abort error:%s, retrying...' % e
-          imapconn = gimaplib.ImapConnect(generateXOAuthString(key, secret, options.email, options.two_legged), options.debug, options.compress)
-          imapconn.select(ALL_MAIL)
-        except socket.error, e:
-          print '\nsocket.error:%s, retrying...' % e
-          imapconn = gimaplib.ImapConnect(generateXOAuthString(key, secret, options.email, options.two_legged), options.debug, options.compress)
-          imapconn.select(ALL_MAIL)
-      #Save the fact that it is completed
-      sqlconn.execute(
-        'INSERT OR IGNORE INTO restored_messages (message_num) VALUES (?)',
-           (message_num,))
-      sqlconn.commit()
+    if options.resume:
+      restore_count -= find_restored(imapconn, sqlconn, readcur, restore_where, msgid_column)
+    # One row per message with its flags, messages are scanned in message_num
+    # order and their flags looked up in flagidx, so nothing is held in memory.
+    messages_to_restore = readcur.execute('''
+      SELECT message_num, message_internaldate, message_filename, %s, %s,
+             group_concat(flag, ' ')
+        FROM messages LEFT JOIN flags USING (message_num)
+        WHERE %s
+        GROUP BY message_num ORDER BY message_num
+    ''' % (codec_columns, msgid_column, restore_where))
+    unreported_messages = 0
+    reconnect = lambda: connect_all_mail(key, secret, options, readonly=False)
+    restorer = MessageRestorer(imapconn, reconnect, options.folder, options.connections,
+                               options.pipeline_depth, first_uid)
+    restorer.start()
+    restored_count = 0
+    while True:
+      with perfstats.timer('sqlite'):
+        messages_chunk = messages_to_restore.fetchmany(options.checkpoint_messages)
+      if not messages_chunk:
+        break
+      # Commit how far restore may get before it hands out the chunk, so
+      # --resume knows which messages could be in Gmail without a record
+      checkpoint_restored(sqlconn, messages_chunk[-1][0])
+      next_checkpoint = time.time() + options.checkpoint_seconds
+      for x in messages_chunk:
+        message_num = x[0]
+        message_internaldate = x[1]
+        message_internaldate_seconds = time.mktime(message_internaldate.timetuple())
+        message_filename = x[2]
+        message_codec = x[3]
+        message_offset = x[4]
+        message_length = x[5]
+        message_msgid = x[6]
+        if not os.path.isfile(os.path.join(options.folder, message_filename)):
+          print 'WARNING! file %s does not exist for message %s' % (os.path.join(options.folder, message_filename), message_num)
+          print '  this message will be skipped.'
+          continue
+        # older databases may have a flag twice
+        flags_string = ' '.join(sorted(set((x[7] or '').split())))
+        restorer.put((message_num, message_internaldate_seconds, message_filename, message_codec,
+                      message_offset, message_length, flags_string, message_msgid))
+        restored = restorer.restored_messages()
+        restored_count += record_restored(sqlconn, restored, restored_count, restore_count)
+        if restorer.error or time.time() >= next_checkpoint:
+          checkpoint_restored(sqlconn)
+          next_checkpoint = time.time() + options.checkpoint_seconds
+        restorer.raise_error()
+        unreported_messages += len(restored)
+        # messages are restored one at a time, report them in batches
+        if unreported_messages >= 100:
+          perfstats.batch(unreported_messages)
+          unreported_messages = 0
+    restorer.finish()
+    restored = restorer.restored_messages(wait=True)
+    restored_count += record_restored(sqlconn, restored, restored_count, restore_count)
+    checkpoint_restored(sqlconn)
+    restorer.raise_error()
+    perfstats.batch(unreported_messages + len(restored))
+    readconn.close()
+    msgstore.close_segment_maps()
+    print "\n"
+    # Labels are added once all messages are in, one STORE per label
+    imapconn = restore_labels(restorer.imapconn, reconnect, sqlconn, options.label_restored,
+                              options.pipeline_depth)
     sqlconn.execute('DETACH resume')
     sqlconn.commit()
   
@@ -870,25 +2210,21 @@ def main(argv):
   elif options.action == 'estimate':
     imapconn.select(ALL_MAIL, readonly=True)
     messages_to_process = getMessagesToBackupList(imapconn, options.gmail_search)
-    messages_to_estimate = []
     #if we have a sqlcur , we'll compare messages to the db
     #otherwise just estimate everything
-    for message_num in messages_to_process:
-      try:
-        sqlcur
-        if message_is_backed_up(message_num, sqlcur, sqlconn, options.folder):
-          continue
-        else:
-          messages_to_estimate.append(message_num)
-      except NameError:
-        messages_to_estimate.append(message_num)
+    try:
+      messages_to_estimate, messages_backed_up = get_backed_up_messages(
+          messages_to_process, sqlcur, options.folder, options.trust_db)
+    except NameError:
+      messages_to_estimate = messages_to_process
     estimate_count = len(messages_to_estimate)
     total_size = float(0)
     messages_at_once = 10000
     print "Messages to estimate: %s" % estimate_count
     estimated_messages = 0
-    for working_messages in batch(messages_to_estimate, messages_at_once):
+    for working_messages in messages_to_estimate.batches(messages_at_once):
       messages_size = get_message_size(imapconn, working_messages)
+      perfstats.batch(len(working_messages))
       total_size = total_size + messages_size
       if total_size > 1048576:
         math_size = total_size/1048576
@@ -911,8 +2247,11 @@ def main(argv):
     sqlconn.close()
   except NameError:
     pass
+  perfstats.finish()
   if options.compress > 1:
     imapconn.display_stats()
+    if tuner:
+      tuner.display_stats()
   imapconn.logout()
   
 if __name__ == '__main__':
@@ -0,0 +1,487 @@
+# Functions to store the message files of a backup folder
+
+import cStringIO
+import errno
+import gzip
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import threading
+import zlib
+try:
+  import fcntl
+except ImportError:
+  # Windows, pack segments are not reopened there
+  fcntl = None
+
+BLOB_FOLDER = 'blobs'
+PACK_FOLDER = 'packs'
+# file name suffix of each message codec, None is a raw .eml file
+CODEC_SUFFIXES = {None: '', 'gzip': '.gz'}
+
+def makedirs(path):
+  if not os.path.isdir(path):
+    try:
+      os.makedirs(path)
+    except OSError:
+      # another connection may have created it meanwhile
+      if not os.path.isdir(path):
+        raise
+
+def dated_filename(uidvalidity, uid, message_date):
+  '''
+  Args:
+    uidvalidity: string, the UIDVALIDITY of the All Mail folder
+    uid: string, the IMAP UID of the message
+    message_date: time.struct_time, the INTERNALDATE of the message
+
+  Returns:
+    string, <year>/<month>/<day>/<uidvalidity>-<uid>.eml relative to the backup folder
+  '''
+  return os.path.join(str(message_date.tm_year),
+                      str(message_date.tm_mon),
+                      str(message_date.tm_mday),
+                      "%s-%s.eml" % (uidvalidity, uid))
+
+def hashed_filename(hexdigest, codec=None):
+  '''
+  Args:
+    hexdigest: string, SHA-1 of the message content
+    codec: string, the codec the file is stored with or None
+
+  Returns:
+    string, blobs/<ab>/<cd>/<hexdigest>.eml relative to the backup folder
+  '''
+  return os.path.join(BLOB_FOLDER, hexdigest[0:2], hexdigest[2:4],
+                      hexdigest + '.eml' + CODEC_SUFFIXES[codec])
+
+def get_layout(rel_filename):
+  '''
+  Returns:
+    string, the layout a message file name belongs to: dated, hashed or pack
+  '''
+  if rel_filename.startswith(BLOB_FOLDER + os.sep):
+    return 'hashed'
+  if rel_filename.startswith(PACK_FOLDER + os.sep):
+    return 'pack'
+  return 'dated'
+
+def plain_filename(rel_filename, codec=None):
+  '''
+  Returns:
+    string, rel_filename without the suffix added for codec
+  '''
+  suffix = CODEC_SUFFIXES[codec]
+  if suffix and rel_filename.endswith(suffix):
+    return rel_filename[:-len(suffix)]
+  return rel_filename
+
+def open_message(backup_folder, rel_filename, codec=None, offset=None, length=None):
+  '''
+  Args:
+    backup_folder: string, the backup folder
+    rel_filename: string, the file name of the message relative to the backup folder
+    codec: string, the codec recorded for the message or None
+    offset: int, where the message starts in a pack segment, None for a message file
+    length: int, the stored length of the message in a pack segment
+
+  Returns:
+    file, the message opened for reading, decompressed as it is read
+  '''
+  full_filename = os.path.join(backup_folder, rel_filename)
+  if codec not in CODEC_SUFFIXES:
+    raise ValueError('unknown message codec %r for %s' % (codec, rel_filename))
+  if offset is not None:
+    data = read_packed(full_filename, offset, length)
+    if codec == 'gzip':
+      data = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(data)
+    return cStringIO.StringIO(data)
+  if codec == 'gzip':
+    return gzip.open(full_filename, 'rb')
+  return open(full_filename, 'rb')
+
+segment_maps = {}
+# guards segment_maps, a map is only read or replaced while holding it so
+# no thread reads a map another one closed
+segment_maps_lock = threading.Lock()
+
+def read_packed(full_filename, offset, length):
+  '''
+  Returns:
+    string, length bytes at offset of a pack segment, read through a mmap
+    of the segment that is kept open for the following messages until
+    close_segment_maps()
+  '''
+  if length == 0:
+    return ''
+  with segment_maps_lock:
+    segment_map = segment_maps.get(full_filename)
+    if segment_map is None or len(segment_map) < offset + length:
+      # the segment grew since it was mapped
+      if segment_map is not None:
+        segment_map.close()
+      f = open(full_filename, 'rb')
+      try:
+        segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      finally:
+        f.close()
+      segment_maps[full_filename] = segment_map
+    return segment_map[offset:offset + length]
+
+def close_segment_maps():
+  '''Closes the segment maps read_packed() kept open, call it when done reading.'''
+  with segment_maps_lock:
+    for full_filename in segment_maps.keys():
+      segment_maps.pop(full_filename).close()
+
+def lock_segment(fd):
+  '''
+  Returns:
+    bool, whether the exclusive lock of a segment was taken, it is held
+    until the segment is closed. Always True without fcntl.
+  '''
+  if fcntl is None:
+    return True
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except IOError, e:
+    if e.errno not in (errno.EAGAIN, errno.EACCES):
+      raise
+    return False
+  return True
+
+class PackSegment(object):
+  '''An append-only segment file that one thread writes messages to.'''
+
+  def __init__(self, rel_filename, fd, size=0):
+    self.rel_filename = rel_filename
+    self.fd = fd
+    self.size = size
+    self.closed = False
+
+  def write(self, data):
+    while data:
+      written = os.write(self.fd, data)
+      self.size += written
+      data = data[written:]
+
+class PackStore(object):
+  '''Appends messages to the segment files under packs/ of a backup folder.
+
+  Every thread appends to its own active segment so messages can be saved
+  from several connections without a lock. A thread first reopens the last
+  segment that is below max_segment_size and that no other process has
+  locked, and only starts a new segment when there is none left. Segments
+  are only ever appended to, so whatever a crash left after the last
+  database commit is never referenced and never overwritten. Call sync()
+  before committing the messages to the database.
+  '''
+
+  max_segment_size = 1073741824
+
+  def __init__(self, backup_folder):
+    self.backup_folder = backup_folder
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.segments = []
+    self.next_number = None
+    # the segments to reopen before new ones are started, the last one last
+    self.reusable = []
+    # segments that are being emptied and are not appended to
+    self.retired = set()
+
+  def retire(self, rel_filenames):
+    with self.lock:
+      self.retired.update(rel_filenames)
+
+  def new_segment(self):
+    with self.lock:
+      pack_folder = os.path.join(self.backup_folder, PACK_FOLDER)
+      if self.next_number is None:
+        makedirs(pack_folder)
+        numbers = sorted(int(name.split('.')[0]) for name in os.listdir(pack_folder)
+                         if re.match(r'^[0-9]+\.pack$', name))
+        self.next_number = max(numbers or [0]) + 1
+        if fcntl is not None:
+          self.reusable = [os.path.join(PACK_FOLDER, '%08d.pack' % number) for number in numbers]
+      segment = self.reopen_segment()
+      if segment is not None:
+        self.segments.append(segment)
+        return segment
+      while True:
+        rel_filename = os.path.join(PACK_FOLDER, '%08d.pack' % self.next_number)
+        self.next_number += 1
+        try:
+          fd = os.open(os.path.join(self.backup_folder, rel_filename),
+                       os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0))
+        except OSError, e:
+          # left by another GYB process
+          if e.errno != errno.EEXIST:
+            raise
+          continue
+        if lock_segment(fd):
+          break
+        # another GYB process reopened it before we could lock it
+        os.close(fd)
+      segment = PackSegment(rel_filename, fd)
+      self.segments.append(segment)
+      return segment
+
+  def reopen_segment(self):
+    '''
+    Returns:
+      object, the next reusable segment opened at its end for appending, or
+      None if there is none. Called with lock held.
+    '''
+    while self.reusable:
+      rel_filename = self.reusable.pop()
+      if rel_filename in self.retired:
+        continue
+      try:
+        fd = os.open(os.path.join(self.backup_folder, rel_filename),
+                     os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+      except OSError, e:
+        # removed by a compact
+        if e.errno != errno.ENOENT:
+          raise
+        continue
+      if lock_segment(fd):
+        size = os.lseek(fd, 0, os.SEEK_END)
+        if size < self.max_segment_size:
+          return PackSegment(rel_filename, fd, size)
+      os.close(fd)
+    return None
+
+  def active_segment(self):
+    segment = getattr(self.local, 'segment', None)
+    if segment is None or segment.closed or segment.size >= self.max_segment_size:
+      segment = self.local.segment = self.new_segment()
+    return segment
+
+  def sync(self, close=False):
+    '''Flushes every segment written to disk, and closes them if close is True.'''
+    with self.lock:
+      for segment in self.segments:
+        os.fsync(segment.fd)
+        if close:
+          os.close(segment.fd)
+          segment.closed = True
+          if fcntl is not None and segment.size < self.max_segment_size:
+            self.reusable.append(segment.rel_filename)
+      if close:
+        self.segments = []
+
+pack_stores = {}
+pack_stores_lock = threading.Lock()
+
+def get_pack_store(backup_folder):
+  with pack_stores_lock:
+    if backup_folder not in pack_stores:
+      pack_stores[backup_folder] = PackStore(backup_folder)
+    return pack_stores[backup_folder]
+
+def retire_segments(backup_folder, rel_filenames):
+  '''
+  Keeps the pack segments rel_filenames of backup_folder from being reopened
+  for appending, so messages moved out of them don't go back in.
+  '''
+  get_pack_store(backup_folder).retire(rel_filenames)
+
+def sync_packs(backup_folder, close=False):
+  '''
+  Makes the messages appended to pack segments of backup_folder durable so
+  they can be committed to the database. Does nothing if none were written.
+  '''
+  with pack_stores_lock:
+    pack_store = pack_stores.get(backup_folder)
+  if pack_store is not None:
+    pack_store.sync(close)
+
+class MessageWriter(object):
+  '''Writes a message to the backup folder one chunk at a time.
+
+  With the 'dated' layout the message is written to rel_filename. With the
+  'hashed' layout the file is named by the SHA-1 of its content so identical
+  messages share one file, and close() returns that name instead. Up to
+  spool_size bytes are kept in memory (no limit if None) so a message whose
+  content is already stored never touches the disk; larger ones are spooled
+  to a temporary file under blobs/.
+
+  With the 'pack' layout rel_filename is ignored and the message is appended
+  to the active segment of this thread, see PackStore. close() returns the
+  segment and sets the offset and length attributes.
+
+  With codec 'gzip' the message is compressed as it is written and the file
+  name gets a .gz suffix. The hash is always of the uncompressed message.
+
+  The header block of the message is collected in the headers attribute.
+  '''
+
+  max_header_size = 1048576
+
+  def __init__(self, backup_folder, rel_filename, layout='dated', spool_size=None,
+               codec=None):
+    self.backup_folder = backup_folder
+    if rel_filename is not None:
+      self.rel_filename = rel_filename + CODEC_SUFFIXES[codec]
+    self.layout = layout
+    self.spool_size = spool_size
+    self.codec = codec
+    self.headers = ''
+    self.headers_complete = False
+    self.f = None
+    self.offset = None
+    self.length = None
+    if codec == 'gzip':
+      # 16 + window bits makes zlib write a gzip header and trailer
+      self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+      self.compressor = None
+    if layout == 'hashed':
+      self.digest = hashlib.sha1()
+      self.spooled = []
+      self.spooled_size = 0
+    elif layout == 'pack':
+      self.segment = get_pack_store(backup_folder).active_segment()
+      self.offset = self.segment.size
+    else:
+      full_filename = os.path.join(backup_folder, self.rel_filename)
+      makedirs(os.path.dirname(full_filename))
+      self.f = open(full_filename, 'wb')
+
+  def write(self, chunk):
+    if not self.headers_complete:
+      self.headers += chunk
+      headers_end = re.search('\r?\n\r?\n', self.headers)
+      if headers_end:
+        self.headers = self.headers[:headers_end.end()]
+        self.headers_complete = True
+      elif len(self.headers) > self.max_header_size:
+        self.headers_complete = True
+    if self.layout == 'hashed':
+      self.digest.update(chunk)
+    if self.compressor is not None:
+      chunk = self.compressor.compress(chunk)
+    self.write_data(chunk, len(chunk))
+
+  def write_data(self, data, size):
+    if self.layout == 'pack':
+      self.segment.write(data)
+    elif self.f is None:
+      self.spooled.append(data)
+      self.spooled_size += size
+      if self.spool_size is None or self.spooled_size <= self.spool_size:
+        return
+      self.spool_to_disk()
+    else:
+      self.f.write(data)
+
+  def spool_to_disk(self):
+    blob_folder = os.path.join(self.backup_folder, BLOB_FOLDER)
+    makedirs(blob_folder)
+    fd, self.temp_filename = tempfile.mkstemp('.tmp', '', blob_folder)
+    self.f = os.fdopen(fd, 'wb')
+    self.f.write(''.join(self.spooled))
+    self.spooled = None
+
+  def close(self):
+    '''
+    Returns:
+      string, the file name of the message relative to the backup folder
+    '''
+    if self.layout == 'pack':
+      if self.compressor is not None:
+        self.segment.write(self.compressor.flush())
+      self.length = self.segment.size - self.offset
+      return self.segment.rel_filename
+    if self.layout != 'hashed':
+      if self.compressor is not None:
+        self.f.write(self.compressor.flush())
+      self.f.close()
+      return self.rel_filename
+    rel_filename = hashed_filename(self.digest.hexdigest(), self.codec)
+    full_filename = os.path.join(self.backup_folder, rel_filename)
+    if self.f is None and os.path.isfile(full_filename):
+      return rel_filename
+    if self.compressor is not None:
+      self.write_data(self.compressor.flush(), 0)
+    if self.f is None:
+      self.spool_to_disk()
+    self.f.close()
+    if not os.path.isfile(full_filename):
+      makedirs(os.path.dirname(full_filename))
+      try:
+        os.rename(self.temp_filename, full_filename)
+        return rel_filename
+      except OSError:
+        # the same content was stored by another connection meanwhile
+        if not os.path.isfile(full_filename):
+          raise
+    os.remove(self.temp_filename)
+    return rel_filename
+
+def convert_message(backup_folder, rel_filename, codec, new_codec, new_layout=None,
+                    offset=None, length=None, spool_size=1048576):
+  '''
+  Args:
+    backup_folder: string, the backup folder
+    rel_filename: string, the file name of the message relative to the backup folder
+    codec: string, the codec the message is stored with or None
+    new_codec: string, the codec to store the message with or None
+    new_layout: string, hashed or pack to move the message to that layout,
+                None to keep its layout
+    offset, length: int, the location of the message in a pack segment
+
+  Returns:
+    tuple, the file name relative to the backup folder, offset and length of the converted message
+
+  The original file is left in place.
+  '''
+  layout = get_layout(rel_filename)
+  if new_layout is not None and new_layout != layout:
+    if new_layout == 'dated':
+      raise ValueError('%s can not be moved to the dated layout' % rel_filename)
+    layout = new_layout
+  if layout == 'dated':
+    new_rel_filename = plain_filename(rel_filename, codec)
+  else:
+    new_rel_filename = None
+  message_writer = MessageWriter(backup_folder, new_rel_filename,
+                                 layout, spool_size, new_codec)
+  f = open_message(backup_folder, rel_filename, codec, offset, length)
+  try:
+    while True:
+      chunk = f.read(65536)
+      if not chunk:
+        break
+      message_writer.write(chunk)
+  finally:
+    f.close()
+  new_rel_filename = message_writer.close()
+  return new_rel_filename, message_writer.offset, message_writer.length
+
+def prune_blobs(backup_folder, referenced_filenames):
+  '''
+  Args:
+    backup_folder: string, the backup folder
+    referenced_filenames: set, message file names still used by the database
+
+  Returns:
+    tuple, the number of files and bytes removed from blobs/
+
+  Also removes temporary files left behind by an interrupted backup.
+  '''
+  removed_files = 0
+  removed_bytes = 0
+  blob_folder = os.path.join(backup_folder, BLOB_FOLDER)
+  for root, dirs, files in os.walk(blob_folder):
+    for name in files:
+      full_filename = os.path.join(root, name)
+      rel_filename = os.path.relpath(full_filename, backup_folder)
+      if rel_filename not in referenced_filenames:
+        removed_bytes += os.path.getsize(full_filename)
+        os.remove(full_filename)
+        removed_files += 1
+  return removed_files, removed_bytes
@@ -0,0 +1,227 @@
+# Per-stage timing of a GYB run for --stats-file
+
+import json
+import math
+import threading
+import time
+
+# Stages nest: a FETCH that streams messages to disk contains the file
+# writes, which contain the socket reads. The seconds of a stage are its own
+# time without the stages nested in it, so the stages of a run add up to the
+# time spent in them and show whether it was network, disk or SQLite bound.
+# Latency percentiles are of the full duration, nested stages included.
+
+# histogram buckets grow by 2^(1/8), about 9%, from 1 microsecond
+BUCKET_BASE = 1e-6
+BUCKETS_PER_DOUBLING = 8
+
+class Histogram(object):
+  '''Counts durations in logarithmic buckets to estimate percentiles.'''
+
+  def __init__(self):
+    self.buckets = {}
+    self.max = 0.0
+
+  def add(self, seconds):
+    if seconds > BUCKET_BASE:
+      bucket = int(math.log(seconds / BUCKET_BASE, 2) * BUCKETS_PER_DOUBLING) + 1
+    else:
+      bucket = 0
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    self.max = max(self.max, seconds)
+
+  def percentile(self, percent):
+    '''Returns the upper bound of the bucket holding the percentile.'''
+    count = sum(self.buckets.itervalues())
+    if not count:
+      return 0.0
+    rank = count * percent / 100.0
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= rank:
+        return min(BUCKET_BASE * 2 ** (float(bucket) / BUCKETS_PER_DOUBLING), self.max)
+    return self.max
+
+class Stage(object):
+
+  def __init__(self):
+    self.count = 0
+    self.seconds = 0.0
+    self.histogram = Histogram()
+
+class Timer(object):
+  '''Context manager timing one occurrence of a stage.'''
+
+  def __init__(self, stats, stage):
+    self.stats = stats
+    self.stage = stage
+
+  def __enter__(self):
+    now = time.time()
+    stack = self.stats.stack()
+    if stack:
+      # the enclosing stage pauses while this one runs
+      stack[-1].own += now - stack[-1].resumed
+    stack.append(self)
+    self.started = self.resumed = now
+    self.own = 0.0
+    return self
+
+  def __exit__(self, *exc_info):
+    now = time.time()
+    self.own += now - self.resumed
+    stack = self.stats.stack()
+    stack.pop()
+    if stack:
+      stack[-1].resumed = now
+    self.stats.record(self.stage, self.own, now - self.started)
+
+class NullTimer(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    pass
+
+NULL_TIMER = NullTimer()
+
+class RunStats(object):
+  '''Collects the stages and counters of a run and writes them as JSON lines.
+
+  batch() writes a line with what happened since the previous batch line,
+  finish() a line with the totals, throughput and latency percentiles of the
+  whole run. Without a stats file nothing is measured.
+  '''
+
+  def __init__(self, stats_file=None, action=None):
+    self.enabled = stats_file is not None
+    self.stats_file = stats_file
+    self.action = action
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.started = self.batch_started = time.time()
+    self.stages = {}
+    self.counters = {}
+    self.batch_stages = {}
+    self.batch_counters = {}
+    self.messages = 0
+    self.batches = 0
+
+  def stack(self):
+    try:
+      return self.local.stack
+    except AttributeError:
+      self.local.stack = []
+      return self.local.stack
+
+  def timer(self, stage):
+    if not self.enabled:
+      return NULL_TIMER
+    return Timer(self, stage)
+
+  def record(self, stage, own_seconds, seconds):
+    with self.lock:
+      if stage not in self.stages:
+        self.stages[stage] = Stage()
+      totals = self.stages[stage]
+      totals.count += 1
+      totals.seconds += own_seconds
+      totals.histogram.add(seconds)
+      count, batch_seconds = self.batch_stages.get(stage, (0, 0.0))
+      self.batch_stages[stage] = (count + 1, batch_seconds + own_seconds)
+
+  def count(self, counter, value=1):
+    if not self.enabled:
+      return
+    with self.lock:
+      for counters in (self.counters, self.batch_counters):
+        total = counters.get(counter, 0) + value
+        # seconds counters are kept to the microsecond like the stages
+        counters[counter] = round(total, 6) if isinstance(total, float) else total
+
+  def write(self, record):
+    with open(self.stats_file, 'a') as f:
+      f.write(json.dumps(record, sort_keys=True) + '\n')
+
+  def throughput(self, record, messages, counters, seconds):
+    record['msgs_per_s'] = round(messages / seconds, 1) if seconds else None
+    for counter, name in (('message_bytes', 'message_mb_per_s'),
+                          ('net_bytes_in', 'net_in_mb_per_s'),
+                          ('net_bytes_out', 'net_out_mb_per_s')):
+      if counter in counters:
+        record[name] = round(counters[counter] / 1048576.0 / seconds, 3) if seconds else None
+
+  def batch(self, messages):
+    '''
+    Args:
+      messages: int, the number of messages the batch processed
+    '''
+    if not self.enabled:
+      return
+    with self.lock:
+      now = time.time()
+      seconds = now - self.batch_started
+      self.batches += 1
+      self.messages += messages
+      record = {'type': 'batch',
+                'action': self.action,
+                'batch': self.batches,
+                'time': now,
+                'seconds': round(seconds, 6),
+                'messages': messages,
+                'stages': dict((stage, {'count': count, 'seconds': round(stage_seconds, 6)})
+                               for stage, (count, stage_seconds) in self.batch_stages.iteritems()),
+                'counters': self.batch_counters}
+      self.throughput(record, messages, self.batch_counters, seconds)
+      self.batch_started = now
+      self.batch_stages = {}
+      self.batch_counters = {}
+      self.write(record)
+
+  def finish(self):
+    '''Writes the totals of the run.'''
+    if not self.enabled:
+      return
+    with self.lock:
+      now = time.time()
+      seconds = now - self.started
+      stages = {}
+      for stage, totals in self.stages.iteritems():
+        stages[stage] = {'count': totals.count,
+                         'seconds': round(totals.seconds, 6),
+                         'p50': round(totals.histogram.percentile(50), 6),
+                         'p90': round(totals.histogram.percentile(90), 6),
+                         'p99': round(totals.histogram.percentile(99), 6),
+                         'max': round(totals.histogram.max, 6)}
+      record = {'type': 'run',
+                'action': self.action,
+                'time': now,
+                'seconds': round(seconds, 6),
+                'messages': self.messages,
+                'batches': self.batches,
+                'stages': stages,
+                'counters': self.counters}
+      self.throughput(record, self.messages, self.counters, seconds)
+      self.write(record)
+
+# The stats of the current run, used by gyb and gimaplib
+current = RunStats()
+
+def start(stats_file, action):
+  global current
+  current = RunStats(stats_file, action)
+  return current
+
+def timer(stage):
+  return current.timer(stage)
+
+def count(counter, value=1):
+  current.count(counter, value)
+
+def batch(messages):
+  current.batch(messages)
+
+def finish():
+  current.finish()